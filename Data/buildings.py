@@ -1772,5 +1772,24 @@ def get_name(building_id):
     """
     return tile_data[building_id]["name"]
 
+
+def get_ids_by(attribute):
+    """
+    Groups the building ids by the value of one of their attributes.
+    Args:
+        attribute (str): attribute of the tiles, like "zone" or "microsim".
+    Returns:
+        A dictionary of {attribute value: list of building ids}, leaving out the tiles that don't have the attribute.
+    """
+    ids = {}
+    for building_id, data in tile_data.items():
+        if attribute in data:
+            ids.setdefault(data[attribute], []).append(building_id)
+    return ids
+
+
+# Arcologies don't have a microsim or zone of their own to find them with.
+arcology_ids = [0xFB, 0xFC, 0xFD, 0xFE]
+
 # Tiles that can have a train sprite drawn on them:
 train_tiles = [k for k, v in tile_data.items() if "Rail" in v["name"] and k not in (108, 109, 110, 111, 237)]
\ No newline at end of file
@@ -0,0 +1,183 @@
+"""
+The layout of the MISC segment of a .sc2 file, which is 4800 bytes of big endian 4 byte ints.
+This is the one definition used by both City.parse_misc() and sc2_serialize.serialize_misc().
+It's compiled into a single struct.Struct, so all of MISC is unpacked or packed in one call.
+"""
+import collections
+import struct
+
+
+"""
+Each field is (offset, name, number of ints, struct format of each int), in the order they appear in MISC.
+Offsets are only used to check that the fields are contiguous, as the layout is compiled from the order and sizes.
+"""
+MISC_LAYOUT = (
+    (0x0000, 'FirstEntry', 1, 'I'),  # nominally the same in every city.
+    (0x0004, 'GameMode', 1, 'I'),
+    (0x0008, 'Compass', 1, 'i'),  # rotation
+    (0x000C, 'baseYear', 1, 'I'),
+    (0x0010, 'simCycle', 1, 'I'),
+    (0x0014, 'TotalFunds', 1, 'I'),
+    (0x0018, 'TotalBonds', 1, 'I'),
+    (0x001C, 'GameLevel', 1, 'I'),
+    (0x0020, 'CityStatus', 1, 'I'),
+    (0x0024, 'CityValue', 1, 'I'),
+    (0x0028, 'LandValue', 1, 'I'),
+    (0x002C, 'CrimeCount', 1, 'I'),
+    (0x0030, 'TrafficCount', 1, 'I'),
+    (0x0034, 'Pollution', 1, 'I'),
+    (0x0038, 'CityFame', 1, 'I'),
+    (0x003C, 'Advertising', 1, 'I'),
+    (0x0040, 'Garbage', 1, 'I'),
+    (0x0044, 'WorkerPercent', 1, 'I'),
+    (0x0048, 'WorkerHealth', 1, 'I'),
+    (0x004C, 'WorkerEducate', 1, 'I'),
+    (0x0050, 'NationalPop', 1, 'I'),
+    (0x0054, 'NationalValue', 1, 'I'),
+    (0x0058, 'NationalTax', 1, 'I'),
+    (0x005C, 'NationalTrend', 1, 'I'),
+    (0x0060, 'heat', 1, 'I'),
+    (0x0064, 'wind', 1, 'I'),
+    (0x0068, 'humid', 1, 'I'),
+    (0x006C, 'weatherTrend', 1, 'I'),
+    (0x0070, 'NewDisaster', 1, 'I'),
+    (0x0074, 'oldResPop', 1, 'I'),
+    (0x0078, 'Rewards', 1, 'I'),
+    (0x007C, 'Population Graphs', 60, 'i'),
+    (0x016C, 'Industry Graphs', 33, 'i'),
+    (0x01F0, 'Tile Counts', 256, 'i'),
+    (0x05F0, 'ZonePop|0', 1, 'I'),
+    (0x05F4, 'ZonePop|1', 1, 'I'),
+    (0x05F8, 'ZonePop|2', 1, 'I'),
+    (0x05FC, 'ZonePop|3', 1, 'I'),
+    (0x0600, 'ZonePop|4', 1, 'I'),
+    (0x0604, 'ZonePop|5', 1, 'I'),
+    (0x0608, 'ZonePop|6', 1, 'I'),
+    (0x060C, 'ZonePop|7', 1, 'I'),
+    (0x0610, 'Bonds', 50, 'i'),
+    (0x06D8, 'Neighbours', 16, 'i'),
+    (0x0718, 'Valve?|0', 1, 'I'),  # reverse engineered from the game, may be a typo in original.
+    (0x071C, 'Valve?|1', 1, 'I'),
+    (0x0720, 'Valve?|2', 1, 'I'),
+    (0x0724, 'Valve?|3', 1, 'I'),
+    (0x0728, 'Valve?|4', 1, 'I'),
+    (0x072C, 'Valve?|5', 1, 'I'),
+    (0x0730, 'Valve?|6', 1, 'I'),
+    (0x0734, 'Valve?|7', 1, 'I'),
+    (0x0738, 'gas_power', 1, 'i'),
+    (0x073C, 'nuclear_power', 1, 'i'),
+    (0x0740, 'solar_power', 1, 'i'),
+    (0x0744, 'wind_power', 1, 'i'),
+    (0x0748, 'microwave_power', 1, 'i'),
+    (0x074C, 'fusion_power', 1, 'i'),
+    (0x0750, 'airport', 1, 'i'),
+    (0x0754, 'highways', 1, 'i'),
+    (0x0758, 'buses', 1, 'i'),
+    (0x075C, 'subways', 1, 'i'),
+    (0x0760, 'water_treatment', 1, 'i'),
+    (0x0764, 'desalinisation', 1, 'i'),
+    (0x0768, 'plymouth', 1, 'i'),
+    (0x076C, 'forest', 1, 'i'),
+    (0x0770, 'darco', 1, 'i'),
+    (0x0774, 'launch', 1, 'i'),
+    (0x0778, 'highway_2', 1, 'i'),
+    (0x077C, 'Budget', 432, 'i'),
+    (0x0E3C, 'YearEnd', 1, 'i'),
+    (0x0E40, 'GlobalSeaLevel', 1, 'i'),
+    (0x0E44, 'terCoast', 1, 'i'),
+    (0x0E48, 'terRiver', 1, 'i'),
+    (0x0E4C, 'Military', 1, 'i'),
+    (0x0E50, 'Paper List', 30, 'i'),
+    (0x0EC8, 'News List', 54, 'i'),
+    (0x0FA0, 'Ordinances', 1, 'I'),
+    (0x0FA4, 'unemployed', 1, 'I'),
+    (0x0FA8, 'Military Count', 16, 'i'),
+    (0x0FE8, 'SubwayCnt', 1, 'I'),
+    (0x0FEC, 'GameSpeed', 1, 'i'),
+    (0x0FF0, 'AutoBudget', 1, 'i'),
+    (0x0FF4, 'AutoGo', 1, 'i'),
+    (0x0FF8, 'UserSoundOn', 1, 'i'),
+    (0x0FFC, 'UserMusicOn', 1, 'i'),
+    (0x1000, 'NoDisasters', 1, 'i'),
+    (0x1004, 'PaperDeliver', 1, 'I'),
+    (0x1008, 'PaperExtra', 1, 'I'),
+    (0x100C, 'PaperChoice', 1, 'I'),
+    (0x1010, 'unknown128', 1, 'I'),
+    (0x1014, 'Zoom', 1, 'i'),
+    (0x1018, 'CityCentX', 1, 'i'),
+    (0x101C, 'CityCentY', 1, 'i'),
+    (0x1020, 'GlobalArcoPop', 1, 'I'),
+    (0x1024, 'ConnectTiles', 1, 'I'),
+    (0x1028, 'TeamsActive', 1, 'I'),
+    (0x102C, 'TotalPop', 1, 'I'),
+    (0x1030, 'IndustryBonus', 1, 'I'),
+    (0x1034, 'PolluteBonus', 1, 'I'),
+    (0x1038, 'oldArrest', 1, 'I'),
+    (0x103C, 'PoliceBonus', 1, 'I'),
+    (0x1040, 'DisasterObject', 1, 'I'),
+    (0x1044, 'CurrentDisaster', 1, 'I'),
+    (0x1048, 'GoDisaster', 1, 'I'),
+    (0x104C, 'SewerBonus', 1, 'I'),
+    (0x1050, 'Extra', 156, 'i'),
+)
+
+
+def compile_layout(layout):
+    """
+    Compiles a MISC layout into a struct, and where each field's values are in what it unpacks to.
+    Args:
+        layout (tuple): layout, like MISC_LAYOUT.
+    Returns:
+        A (struct.Struct, {field name: slice of the unpacked values}) tuple.
+    Raises:
+        ValueError: if there are gaps or overlaps between the fields.
+    """
+    formats = ['>']
+    field_slices = collections.OrderedDict()
+    offset = 0
+    value_idx = 0
+    for field_offset, name, count, field_format in layout:
+        if field_offset != offset:
+            raise ValueError(f"MISC field {name} is at 0x{field_offset:04X}, but the previous field ended at 0x{offset:04X}.")
+        formats.append(f"{count}{field_format}")
+        field_slices[name] = slice(value_idx, value_idx + count)
+        offset += count * 4
+        value_idx += count
+    return struct.Struct(''.join(formats)), field_slices
+
+
+MISC_STRUCT, MISC_FIELD_SLICES = compile_layout(MISC_LAYOUT)
+MISC_SIZE = MISC_STRUCT.size
+
+
+def unpack_misc(misc_data):
+    """
+    Unpacks all of the fields of MISC.
+    Args:
+        misc_data (bytes): MISC segment of the raw data from the .sc2 file.
+    Returns:
+        An ordered dictionary of {field name: tuple of the field's ints}, in the order they appear in MISC.
+    """
+    values = MISC_STRUCT.unpack_from(misc_data)
+    return collections.OrderedDict((name, values[field_slice]) for name, field_slice in MISC_FIELD_SLICES.items())
+
+
+def pack_misc(fields):
+    """
+    Packs all of the fields of MISC.
+    Args:
+        fields (dict): {field name: sequence of the field's ints} for every field in MISC_LAYOUT.
+    Returns:
+        Bytearray of the MISC segment.
+    Raises:
+        ValueError: if a field has the wrong number of ints.
+    """
+    values = []
+    for name, field_slice in MISC_FIELD_SLICES.items():
+        field_values = fields[name]
+        if len(field_values) != field_slice.stop - field_slice.start:
+            raise ValueError(f"MISC field {name} should have {field_slice.stop - field_slice.start} values, but has {len(field_values)}.")
+        values.extend(field_values)
+    output_bytes = bytearray(MISC_SIZE)
+    MISC_STRUCT.pack_into(output_bytes, 0, *values)
+    return output_bytes
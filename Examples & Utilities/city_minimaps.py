@@ -188,11 +188,9 @@ def draw_buildings_highlight(city, palette, base_minimap, highlight=[255]):
         A Pillow image.
     """
     output_minimap = deepcopy(base_minimap)
-    for coords, tile in city.tilelist.items():
-        if tile.building:
-            if tile.building.building_id in highlight:
-                colour = palette[255]
-                output_minimap.putpixel(coords, colour)
+    colour = palette[255]
+    for coords in city.building_index.footprint(highlight):
+        output_minimap.putpixel(coords, colour)
     return output_minimap
 
 
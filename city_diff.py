@@ -0,0 +1,166 @@
+import re
+
+import Data.misc_layout as misc_layout
+import sc2_serialize as sc2s
+from utils import xor_bytes
+
+
+# Layers compared by diff_cities(), and how many bytes each tile (or minimap cell) takes up in the chunk.
+TILE_LAYERS = {"ALTM": 2, "XTER": 1, "XBLD": 1, "XZON": 1, "XUND": 1, "XTXT": 1, "XBIT": 1}
+
+
+class CityDiff:
+    """
+    The differences between two cities, as found by diff_cities().
+    Values are recorded as they're stored in the city file, so for example an ALTM change is the whole uint16 for the tile.
+    """
+    def __init__(self):
+        # {chunk id: {(row, col): (old value, new value)}} for each of the per-tile chunks that changed.
+        # The minimap chunks, like "XTRF", are here too, keyed by (x, y) minimap coordinates instead.
+        self.layers = {}
+        # {MISC field: (old value, new value)}.
+        # Fields with more than one value are split up into "name|index", like "Tile Counts|12", the same way as City.city_attributes.
+        self.misc = {}
+        # {label id: (old label, new label)}, with None for a label that's only in one of the cities.
+        self.labels = {}
+        # {thing id: (old thing bytes, new thing bytes)}, with None for a thing that's only in one of the cities.
+        self.things = {}
+
+    def changed_tiles(self):
+        """
+        Returns:
+            Set of the (row, col) of every tile that changed in any of the per-tile chunks.
+        """
+        return set().union(*(v for k, v in self.layers.items() if k in TILE_LAYERS))
+
+    def __bool__(self):
+        return bool(self.layers or self.misc or self.labels or self.things)
+
+    def __str__(self):
+        layers = ', '.join(f"{k}: {len(v)}" for k, v in self.layers.items())
+        return f"City diff: changed layer values: {{{layers}}}, MISC fields: {len(self.misc)}, labels: {len(self.labels)}, things: {len(self.things)}."
+
+
+def layer_chunks(city):
+    """
+    Gets the bytes of every layer of a city compared by diff_cities().
+    Args:
+        city (City): city to get the layers of.
+    Returns:
+        A dictionary of {chunk id: bytes} for the per-tile chunks in TILE_LAYERS and the 8 minimap chunks.
+    """
+    chunks = sc2s.serialize_tiles(city)
+    chunks["XBLD"] = sc2s.serialize_building_data(city)
+    for chunk_name, minimap_name in city._minimap_chunk_names.items():
+        chunks[chunk_name] = getattr(city, minimap_name).tobytes()
+    return chunks
+
+
+def diff_layer(old_layer, new_layer, width, item_size=1):
+    """
+    Finds the values that differ between two versions of a row major layer, like an XTER chunk.
+    The layers are compared all at once, by XORing them and then only visiting the bytes that aren't 0.
+    Args:
+        old_layer (bytes): layer from the old city.
+        new_layer (bytes): layer from the new city.
+        width (int): number of values in each row.
+        item_size (int): number of bytes in each value, which are big endian.
+    Returns:
+        A dictionary of {(row, col): (old value, new value)} for each value that changed.
+    Raises:
+        ValueError: if the layers aren't the same size.
+    """
+    if len(old_layer) != len(new_layer):
+        raise ValueError(f"Can't compare layers of different sizes: {len(old_layer)}B and {len(new_layer)}B.")
+    changes = {}
+    if old_layer == new_layer:
+        return changes
+    for match in re.finditer(b'[^\x00]', xor_bytes(old_layer, new_layer)):
+        idx = match.start() // item_size
+        key = divmod(idx, width)
+        # A multibyte value can have more than one changed byte.
+        if key in changes:
+            continue
+        start = idx * item_size
+        old_value = int.from_bytes(old_layer[start : start + item_size], 'big')
+        new_value = int.from_bytes(new_layer[start : start + item_size], 'big')
+        changes[key] = (old_value, new_value)
+    return changes
+
+
+def diff_misc(old_misc, new_misc):
+    """
+    Finds the MISC fields that differ between two MISC chunks.
+    Args:
+        old_misc (bytes): MISC chunk from the old city.
+        new_misc (bytes): MISC chunk from the new city.
+    Returns:
+        A dictionary of {field: (old value, new value)}, with fields with more than one value split up into "name|index".
+    """
+    changes = {}
+    if old_misc == new_misc:
+        return changes
+    new_fields = misc_layout.unpack_misc(new_misc)
+    for name, old_values in misc_layout.unpack_misc(old_misc).items():
+        new_values = new_fields[name]
+        if old_values == new_values:
+            continue
+        if len(old_values) == 1:
+            changes[name] = (old_values[0], new_values[0])
+            continue
+        for idx, (old_value, new_value) in enumerate(zip(old_values, new_values)):
+            if old_value != new_value:
+                changes[f"{name}|{idx}"] = (old_value, new_value)
+    return changes
+
+
+def diff_dicts(old_dict, new_dict):
+    """
+    Finds the entries that differ between two dictionaries.
+    Args:
+        old_dict (dict): dictionary from the old city.
+        new_dict (dict): dictionary from the new city.
+    Returns:
+        A dictionary of {key: (old value, new value)} for each entry that changed, with None for an entry that's only in one of them.
+    """
+    changes = {}
+    for key in old_dict.keys() | new_dict.keys():
+        old_value = old_dict.get(key)
+        new_value = new_dict.get(key)
+        if old_value != new_value:
+            changes[key] = (old_value, new_value)
+    return changes
+
+
+def diff_cities(old_city, new_city):
+    """
+    Compares two cities, such as two autosaves of the same city, layer by layer.
+    Every layer is compared for the whole map at once, so this only takes a few milliseconds for columnar cities.
+    Args:
+        old_city (City): city to compare from.
+        new_city (City): city to compare to.
+    Returns:
+        CityDiff of what changed going from old_city to new_city.
+    Raises:
+        ValueError: if the cities aren't the same size.
+    """
+    if old_city.city_size != new_city.city_size:
+        raise ValueError(f"Can't compare cities of different sizes: {old_city.city_size} and {new_city.city_size}.")
+    diff = CityDiff()
+    old_chunks = layer_chunks(old_city)
+    new_chunks = layer_chunks(new_city)
+    for chunk_name, old_layer in old_chunks.items():
+        if chunk_name in TILE_LAYERS:
+            changes = diff_layer(old_layer, new_chunks[chunk_name], old_city.city_size, TILE_LAYERS[chunk_name])
+        else:
+            minimap = getattr(old_city, old_city._minimap_chunk_names[chunk_name])
+            changes = diff_layer(old_layer, new_chunks[chunk_name], minimap.size)
+        if changes:
+            diff.layers[chunk_name] = changes
+
+    diff.misc = diff_misc(sc2s.serialize_misc(old_city), sc2s.serialize_misc(new_city))
+    diff.labels = diff_dicts(old_city.labels, new_city.labels)
+    old_things = {k: bytes(v.serialize_thing()) for k, v in old_city.things.items()}
+    new_things = {k: bytes(v.serialize_thing()) for k, v in new_city.things.items()}
+    diff.things = diff_dicts(old_things, new_things)
+    return diff
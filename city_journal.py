@@ -0,0 +1,257 @@
+import collections
+import contextlib
+
+import sc2_parse
+
+
+# A change to one value of a city.
+# layer is what was changed:
+#     A tile attribute, like "altitude" or "building", with coords being the (row, col) of the tile.
+#     A minimap, like "traffic", with coords being the (x, y) minimap coordinates.
+#     "budget", with coords being (budget item, field), like ("Police", "current_funding").
+#     Any other dictionary attribute of City, like "city_attributes" or "labels", with coords being the key.
+JournalEntry = collections.namedtuple('JournalEntry', ['layer', 'coords', 'old', 'new'])
+
+# Stands in for the old value of a dictionary entry that didn't exist before it was set, so undoing it removes the entry.
+MISSING = object()
+
+
+class Transaction:
+    """
+    A group of changes to a city that are undone and redone together, like everything done by one use of an editing tool.
+    """
+    def __init__(self, description=''):
+        """
+        Args:
+            description (str): what the changes were, for showing in an editor.
+        """
+        self.description = description
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return f"Transaction: '{self.description}' with {len(self.entries)} changes."
+
+
+class CityJournal:
+    """
+    Records the changes made to a city, so that they can be undone and redone.
+    Changes are recorded as the old and new value of each tile attribute, minimap value or other field that changed, so undoing or redoing a change only touches what it changed, rather than copying the whole city.
+    Changes need to be made through set() and the other set_ methods, or recorded with record() if they're made some other way.
+    Changes are grouped into transactions. Outside of transaction(), each change is its own transaction.
+    Only the last max_depth transactions are kept, so memory use is bounded.
+    """
+    _tile_attributes = ('altitude_tunnel', 'altidue_tunnel', 'water_depth', 'altitude_unknown', 'altitude', 'terrain',
+                        'building', 'zone_corners', 'zone', 'underground', 'text_pointer', 'bit_flags')
+
+    def __init__(self, city, max_depth=100):
+        """
+        Args:
+            city (City): city to record the changes of.
+            max_depth (int): maximum number of transactions that can be undone.
+        """
+        self.city = city
+        self.max_depth = max_depth
+        self.undo_stack = collections.deque(maxlen=max_depth)
+        self.redo_stack = collections.deque(maxlen=max_depth)
+        # Transaction that changes are currently being added to, if inside transaction().
+        self.current = None
+
+    @contextlib.contextmanager
+    def transaction(self, description=''):
+        """
+        Groups the changes made inside a with block into a single transaction.
+        If an exception is raised inside the block, the changes made so far are undone.
+        Nested transactions are part of the outermost one.
+        Args:
+            description (str): what the changes are, for showing in an editor.
+        Yields:
+            The Transaction.
+        """
+        if self.current is not None:
+            yield self.current
+            return
+        self.current = Transaction(description)
+        try:
+            yield self.current
+        except BaseException:
+            transaction, self.current = self.current, None
+            self.revert(transaction)
+            raise
+        transaction, self.current = self.current, None
+        self.commit(transaction)
+
+    def commit(self, transaction):
+        """
+        Adds a finished transaction to the history, which makes everything that was undone unable to be redone.
+        Args:
+            transaction (Transaction): transaction to add. Empty transactions are ignored.
+        """
+        if not transaction.entries:
+            return
+        self.undo_stack.append(transaction)
+        self.redo_stack.clear()
+
+    def record(self, layer, coords, old, new):
+        """
+        Records a change that has already been made to the city.
+        Args:
+            layer (str): what was changed, see JournalEntry.
+            coords: which value of the layer was changed, see JournalEntry.
+            old: value before the change.
+            new: value after the change.
+        """
+        entry = JournalEntry(layer, coords, old, new)
+        if self.current is not None:
+            self.current.entries.append(entry)
+            return
+        transaction = Transaction()
+        transaction.entries.append(entry)
+        self.commit(transaction)
+
+    def get(self, layer, coords):
+        """
+        Gets a value from the city.
+        Args:
+            layer (str): what to get, see JournalEntry.
+            coords: which value of the layer to get, see JournalEntry.
+        Returns:
+            The value, or MISSING for a dictionary entry that doesn't exist.
+        """
+        if layer in self._tile_attributes:
+            value = getattr(self.city.tilelist[coords], layer)
+            # Stored as an int, as a tile's BitFlags object changes along with the tile.
+            if layer == 'bit_flags' and value is not None:
+                value = int(value)
+            return value
+        if layer in self.city._minimap_chunk_names.values():
+            return getattr(self.city, layer)[coords]
+        if layer == 'budget':
+            item, field = coords
+            return self.city.budget.budget_items[item][field]
+        return getattr(self.city, layer).get(coords, MISSING)
+
+    def apply(self, layer, coords, value):
+        """
+        Sets a value in the city, without recording it.
+        Args:
+            layer (str): what to set, see JournalEntry.
+            coords: which value of the layer to set, see JournalEntry.
+            value: value to set, with MISSING removing a dictionary entry.
+        """
+        if layer in self._tile_attributes:
+            if layer == 'bit_flags' and value is not None:
+                value = sc2_parse.BitFlags(value)
+            setattr(self.city.tilelist[coords], layer, value)
+        elif layer in self.city._minimap_chunk_names.values():
+            getattr(self.city, layer)[coords] = value
+        elif layer == 'budget':
+            item, field = coords
+            self.city.budget.budget_items[item][field] = value
+        elif value is MISSING:
+            getattr(self.city, layer).pop(coords, None)
+        else:
+            getattr(self.city, layer)[coords] = value
+
+    def set(self, layer, coords, value):
+        """
+        Sets a value in the city, and records the change.
+        Args:
+            layer (str): what to set, see JournalEntry.
+            coords: which value of the layer to set, see JournalEntry.
+            value: new value.
+        Returns:
+            The old value.
+        """
+        old = self.get(layer, coords)
+        if layer == 'bit_flags' and value is not None:
+            value = int(value)
+        self.apply(layer, coords, value)
+        if old != value:
+            self.record(layer, coords, old, value)
+        return old
+
+    def set_tile(self, coords, attribute, value):
+        """
+        Sets an attribute of a tile, like its altitude, and records the change.
+        Args:
+            coords (tuple): (row, col) of the tile.
+            attribute (str): name of the attribute.
+            value: new value.
+        Returns:
+            The old value.
+        """
+        return self.set(attribute, coords, value)
+
+    def set_minimap(self, minimap_name, coords, value):
+        """
+        Sets a minimap value, and records the change.
+        Args:
+            minimap_name (str): name of the minimap, like "traffic".
+            coords (tuple): (x, y) minimap coordinates.
+            value (int): new value.
+        Returns:
+            The old value.
+        """
+        return self.set(minimap_name, coords, value)
+
+    def set_budget(self, item, field, value):
+        """
+        Sets a budget value, and records the change.
+        Args:
+            item (str): budget item, like "Police".
+            field (str): field of the item, like "current_funding".
+            value (int): new value.
+        Returns:
+            The old value.
+        """
+        return self.set('budget', (item, field), value)
+
+    def revert(self, transaction):
+        """
+        Puts back the old values of every change in a transaction, newest first.
+        Args:
+            transaction (Transaction): transaction to revert.
+        """
+        for entry in reversed(transaction.entries):
+            self.apply(entry.layer, entry.coords, entry.old)
+
+    def undo(self):
+        """
+        Undoes the last transaction.
+        Returns:
+            The Transaction that was undone, or None if there's nothing to undo.
+        """
+        if self.current is not None:
+            raise RuntimeError("Can't undo inside of a transaction.")
+        if not self.undo_stack:
+            return None
+        transaction = self.undo_stack.pop()
+        self.revert(transaction)
+        self.redo_stack.append(transaction)
+        return transaction
+
+    def redo(self):
+        """
+        Redoes the last transaction that was undone.
+        Returns:
+            The Transaction that was redone, or None if there's nothing to redo.
+        """
+        if self.current is not None:
+            raise RuntimeError("Can't redo inside of a transaction.")
+        if not self.redo_stack:
+            return None
+        transaction = self.redo_stack.pop()
+        for entry in transaction.entries:
+            self.apply(entry.layer, entry.coords, entry.new)
+        self.undo_stack.append(transaction)
+        return transaction
+
+    def clear(self):
+        """
+        Forgets every transaction, such as after a city is saved.
+        """
+        self.undo_stack.clear()
+        self.redo_stack.clear()
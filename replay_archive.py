@@ -0,0 +1,350 @@
+import collections
+import io
+import lzma
+import os
+import zlib
+
+import sc2_iff_parse as sc2p
+import sc2_parse
+import sc2_serialize as sc2s
+from utils import parse_uint32, serialize_int32, xor_bytes
+
+
+class ReplayArchive:
+    """
+    Stores the history of a city, such as years of its autosaves, in a single file.
+    Rather than a full copy of every save, a keyframe with a full copy of the city is followed by deltas, which only hold the chunks that changed since the save before.
+    A new keyframe is started every keyframe_interval saves, so getting a save back only needs the deltas since the keyframe before it.
+    Saves can be appended to the end of the archive one at a time, as they're made.
+
+    The archive is a sequence of IFF style chunks, without a FORM header, because its size would have to be rewritten on every append:
+        HEAD: 4 byte name of the compression used, followed by the keyframe interval as a uint32.
+        KEYF: a keyframe.
+        DELT: a delta from the save before.
+    Each save is compressed, and is made up of records, one per chunk of the city that changed, each of which is an op byte followed by an IFF chunk:
+        0 (full): the chunk data replaces the chunk.
+        1 (xor): the chunk data is XORed with the same chunk from the save before. Unchanged bytes are 0, which compresses well.
+        2 (delete): the chunk isn't in this save.
+    As the scenario can have more than one TEXT chunk, a record for TEXT holds all of them, one after the other with their IFF chunk headers.
+    """
+    _compressors = {'zlib': (zlib.compress, zlib.decompress), 'lzma': (lzma.compress, lzma.decompress)}
+    _op_full = 0
+    _op_xor = 1
+    _op_delete = 2
+
+    def __init__(self, archive_path, compression='zlib', keyframe_interval=30):
+        """
+        Opens an archive, creating it if it doesn't exist.
+        Args:
+            archive_path (path): path to the archive.
+            compression (str): compression to use for a new archive, "zlib" or "lzma". An existing archive keeps its own.
+            keyframe_interval (int): number of saves per keyframe for a new archive. An existing archive keeps its own.
+        Raises:
+            ValueError: if the file isn't a replay archive, or the compression isn't supported.
+        """
+        self.archive_path = archive_path
+        # (is keyframe, offset of the data, size of the data) for each save, in order.
+        self.frames = []
+        # Chunks of the last save, which the next delta is from. Only reconstructed when the next save is appended.
+        self._last_frame = None
+        if os.path.exists(archive_path) and os.path.getsize(archive_path) > 0:
+            self.read_index()
+            return
+        if compression not in self._compressors:
+            raise ValueError(f"Unsupported compression: {compression}.")
+        self.compression = compression
+        self.keyframe_interval = keyframe_interval
+        header = bytes(compression, 'ascii') + serialize_int32(keyframe_interval)
+        with open(archive_path, 'wb') as f:
+            f.write(b"HEAD" + serialize_int32(len(header)) + header)
+        self._end_offset = 8 + len(header)
+
+    def read_index(self):
+        """
+        Reads the header of the archive, and finds where each save in it is, without reading the saves themselves.
+        Raises:
+            ValueError: if the file isn't a replay archive.
+        """
+        self.frames = []
+        with open(self.archive_path, 'rb') as f:
+            header = f.read(16)
+            if len(header) != 16 or header[0 : 4] != b"HEAD":
+                raise ValueError(f"Not a replay archive: {self.archive_path}")
+            self.compression = header[8 : 12].decode('ascii', 'replace')
+            if self.compression not in self._compressors:
+                raise ValueError(f"Unsupported compression: {self.compression}.")
+            self.keyframe_interval = parse_uint32(header[12 : 16])
+            offset = 16
+            while True:
+                chunk_header = f.read(8)
+                if len(chunk_header) < 8:
+                    break
+                chunk_size = parse_uint32(chunk_header[4 : 8])
+                if offset + 8 + chunk_size > os.fstat(f.fileno()).st_size:
+                    # A save that was only partly written, such as from a crash, is ignored, and overwritten by the next append.
+                    print(f"Ignoring truncated save at the end of replay archive: {self.archive_path}")
+                    break
+                self.frames.append((chunk_header[0 : 4] == b"KEYF", offset + 8, chunk_size))
+                offset += 8 + chunk_size
+                f.seek(offset)
+        self._end_offset = offset
+
+    def append(self, chunks):
+        """
+        Adds a save to the end of the archive, as a keyframe or as a delta from the save before.
+        Args:
+            chunks (dict): uncompressed {chunk id: chunk data} of the save, like from sc2_iff_parse.sc2_uncompress_input(), with TEXT being a list of chunks.
+        """
+        chunks = collections.OrderedDict((k, normalize_chunk(k, v)) for k, v in chunks.items())
+        previous = self._last_frame
+        if previous is None and self.frames:
+            previous = self.get_chunks(len(self.frames) - 1)
+        keyframe = previous is None or len(self.frames) % self.keyframe_interval == 0 or not delta_order_ok(previous, chunks)
+        payload = self.encode_frame(chunks, None if keyframe else previous)
+        compress, _ = self._compressors[self.compression]
+        frame_data = compress(bytes(payload))
+        with open(self.archive_path, 'r+b') as f:
+            f.seek(self._end_offset)
+            f.write((b"KEYF" if keyframe else b"DELT") + serialize_int32(len(frame_data)))
+            f.write(frame_data)
+            f.truncate()
+        self.frames.append((keyframe, self._end_offset + 8, len(frame_data)))
+        self._end_offset += 8 + len(frame_data)
+        self._last_frame = chunks
+
+    def append_file(self, city_path):
+        """
+        Adds a .sc2 file to the end of the archive.
+        Args:
+            city_path (path): path to the city file.
+        """
+        self.append(chunks_from_directory(sc2p.ChunkDirectory.from_file(city_path, 'sc2')))
+
+    def append_city(self, city):
+        """
+        Adds a city to the end of the archive.
+        The city is serialized the same way as when it's saved, so it's also marked as saved.
+        Args:
+            city (City): city to add.
+        """
+        self.append(chunks_from_directory(sc2p.ChunkDirectory(bytes(city.serialize()), 'sc2')))
+
+    def encode_frame(self, chunks, previous):
+        """
+        Encodes the records for a save.
+        Args:
+            chunks (OrderedDict): chunks of the save.
+            previous (OrderedDict): chunks of the save before, or None for a keyframe.
+        Returns:
+            Uncompressed bytes of the records.
+        """
+        records = bytearray()
+        for chunk_id, chunk_data in chunks.items():
+            chunk_data = pack_chunk_data(chunk_id, chunk_data)
+            previous_data = None if previous is None or chunk_id not in previous else pack_chunk_data(chunk_id, previous[chunk_id])
+            if chunk_data == previous_data:
+                continue
+            if previous_data is not None and len(previous_data) == len(chunk_data):
+                records += encode_record(self._op_xor, chunk_id, xor_bytes(previous_data, chunk_data))
+            else:
+                records += encode_record(self._op_full, chunk_id, chunk_data)
+        if previous is not None:
+            for chunk_id in previous.keys() - chunks.keys():
+                records += encode_record(self._op_delete, chunk_id, b'')
+        return records
+
+    def decode_frame(self, frame_idx, previous):
+        """
+        Decodes a save.
+        Args:
+            frame_idx (int): index of the save.
+            previous (OrderedDict): chunks of the save before it, or None if it's a keyframe.
+        Returns:
+            OrderedDict of the chunks of the save.
+        """
+        _, offset, size = self.frames[frame_idx]
+        with open(self.archive_path, 'rb') as f:
+            f.seek(offset)
+            frame_data = f.read(size)
+        _, decompress = self._compressors[self.compression]
+        records = decompress(frame_data)
+        chunks = collections.OrderedDict() if previous is None else collections.OrderedDict(previous)
+        offset = 0
+        while offset < len(records):
+            op = records[offset]
+            chunk_id, chunk_size, chunk_data = sc2p.get_chunk_from_offset(records, offset + 1)
+            offset += 9 + chunk_size
+            if op == self._op_delete:
+                chunks.pop(chunk_id, None)
+            elif op == self._op_xor:
+                chunks[chunk_id] = unpack_chunk_data(chunk_id, xor_bytes(pack_chunk_data(chunk_id, chunks[chunk_id]), chunk_data))
+            else:
+                chunks[chunk_id] = unpack_chunk_data(chunk_id, chunk_data)
+        return chunks
+
+    def get_chunks(self, frame_idx):
+        """
+        Gets a save from the archive, starting from the keyframe before it.
+        Args:
+            frame_idx (int): index of the save, with negative indices counting from the end.
+        Returns:
+            OrderedDict of the uncompressed {chunk id: chunk data} of the save, with TEXT being a list of chunks.
+        Raises:
+            IndexError: if there's no such save.
+        """
+        if frame_idx < 0:
+            frame_idx += len(self.frames)
+        if not 0 <= frame_idx < len(self.frames):
+            raise IndexError(frame_idx)
+        keyframe_idx = frame_idx
+        while not self.frames[keyframe_idx][0]:
+            keyframe_idx -= 1
+        chunks = None
+        for idx in range(keyframe_idx, frame_idx + 1):
+            chunks = self.decode_frame(idx, chunks)
+        return chunks
+
+    def get_city(self, frame_idx, columnar=False):
+        """
+        Gets a save from the archive as a city.
+        Args:
+            frame_idx (int): index of the save, with negative indices counting from the end.
+            columnar (bool): see City.
+        Returns:
+            City of the save.
+        """
+        return city_from_chunks(self.get_chunks(frame_idx), columnar)
+
+    def iter_chunks(self, start=0):
+        """
+        Goes through the saves in the archive in order, decoding each one from the one before.
+        Args:
+            start (int): index of the first save.
+        Yields:
+            OrderedDict of the chunks of each save, as from get_chunks().
+        """
+        chunks = None
+        for idx in range(start, len(self.frames)):
+            if chunks is None:
+                chunks = self.get_chunks(idx)
+            else:
+                chunks = self.decode_frame(idx, None if self.frames[idx][0] else chunks)
+            yield chunks
+
+    def iter_cities(self, start=0, columnar=False):
+        """
+        Goes through the saves in the archive in order, as cities.
+        Args:
+            start (int): index of the first save.
+            columnar (bool): see City.
+        Yields:
+            City of each save.
+        """
+        for chunks in self.iter_chunks(start):
+            yield city_from_chunks(chunks, columnar)
+
+    def __len__(self):
+        return len(self.frames)
+
+
+def normalize_chunk(chunk_id, chunk_data):
+    """
+    Args:
+        chunk_id (str): id of the chunk, like "MISC".
+        chunk_data: data of the chunk, or a list of them for TEXT.
+    Returns:
+        The chunk data as immutable bytes, or a list of bytes for TEXT.
+    """
+    if chunk_id == "TEXT":
+        return [bytes(x) for x in chunk_data]
+    return bytes(chunk_data)
+
+
+def pack_chunk_data(chunk_id, chunk_data):
+    """
+    Packs a chunk's data into the bytes stored in a record, which is the chunk data, except for TEXT.
+    Args:
+        chunk_id (str): id of the chunk.
+        chunk_data: data of the chunk, or a list of them for TEXT.
+    Returns:
+        Bytes for the record.
+    """
+    if chunk_id == "TEXT":
+        return b''.join(b"TEXT" + serialize_int32(len(x)) + x for x in chunk_data)
+    return chunk_data
+
+
+def unpack_chunk_data(chunk_id, record_data):
+    """
+    Inverse of pack_chunk_data().
+    Args:
+        chunk_id (str): id of the chunk.
+        record_data (bytes): bytes from the record.
+    Returns:
+        The data of the chunk, or a list of them for TEXT.
+    """
+    if chunk_id != "TEXT":
+        return bytes(record_data)
+    text_chunks = []
+    offset = 0
+    while offset < len(record_data):
+        _, chunk_size, chunk_data = sc2p.get_chunk_from_offset(record_data, offset)
+        text_chunks.append(bytes(chunk_data))
+        offset += 8 + chunk_size
+    return text_chunks
+
+
+def encode_record(op, chunk_id, record_data):
+    """
+    Args:
+        op (int): what the record does to the chunk.
+        chunk_id (str): id of the chunk.
+        record_data (bytes): data of the record.
+    Returns:
+        Bytes of the record.
+    """
+    return bytes([op]) + bytes(chunk_id, 'ascii') + serialize_int32(len(record_data)) + record_data
+
+
+def delta_order_ok(previous, chunks):
+    """
+    Checks that decoding a delta would put the chunks back in the same order, as deleted chunks are removed and new ones are added at the end.
+    Args:
+        previous (dict): chunks of the save before.
+        chunks (dict): chunks of the save.
+    Returns:
+        True if a delta keeps the order, False if this save needs to be a keyframe.
+    """
+    return [k for k in previous if k in chunks] + [k for k in chunks if k not in previous] == list(chunks)
+
+
+def chunks_from_directory(uncompressed_city):
+    """
+    Args:
+        uncompressed_city (ChunkDirectory): city file.
+    Returns:
+        OrderedDict of the uncompressed {chunk id: chunk data} of the city, with TEXT being a list of chunks.
+    """
+    return collections.OrderedDict((k, normalize_chunk(k, uncompressed_city[k])) for k in uncompressed_city)
+
+
+def city_from_chunks(chunks, columnar=False):
+    """
+    Creates a city from the uncompressed chunks of a save.
+    Args:
+        chunks (dict): uncompressed {chunk id: chunk data}, with TEXT being a list of chunks.
+        columnar (bool): see City.
+    Returns:
+        The City.
+    """
+    compressed_chunks = []
+    for chunk_id, chunk_data in sc2p.sc2_compress_output(chunks, 'sc2').items():
+        if chunk_id == "TEXT":
+            compressed_chunks += [(chunk_id, x) for x in chunk_data]
+        else:
+            compressed_chunks.append((chunk_id, bytes(chunk_data)))
+    city_file = io.BytesIO()
+    sc2s.write_chunks(city_file, compressed_chunks, "SCDH")
+    city = sc2_parse.City(columnar)
+    city.create_city_from_data(sc2p.ChunkDirectory(city_file.getvalue(), 'sc2'))
+    return city
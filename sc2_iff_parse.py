@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 
 import collections
+import collections.abc
+import concurrent.futures
 import itertools
-from utils import open_file, parse_uint8, write_file_contents, get_padded_bytes, parse_int32, parse_uint32
+import os.path
+import re
+from utils import open_file, open_file_mmap, parse_uint8, write_file_contents, get_padded_bytes, parse_int32, parse_uint32
 
 SC2_SIZE_DICT = collections.OrderedDict((('CNAM', 32), ('MISC', 4800), ('ALTM', 32768), ('XTER', 16384), ('XBLD', 16384),
         ('XZON', 16384), ('XUND', 16384), ('XTXT', 16384), ('XLAB', 6400), ('XMIC', 1200),
         ('XTHG', 480), ('XBIT', 16384), ('XTRF', 4096), ('XPLT', 4096), ('XVAL', 4096), ('XCRM', 4096),
         ('XPLC', 1024), ('XFIR', 1024), ('XPOP', 1024), ('XROG', 1024), ('XGRP', 3328), ('TEXT', 0), ('SCEN', 0), ('PICT', 0),))
 SCENARIO_CHUNKS = ('TEXT', 'SCEN', 'PICT')
+# Matches runs of 2 or more of the same byte, for RLE compression.
+REPEAT_RUN_PATTERN = re.compile(rb'(.)\1+', re.DOTALL)
 
 SC2 = True
 
@@ -26,6 +32,8 @@ class SC2Parse(IFFParse):
     Exceptions for when parsing a SC2 file fails.
     """
     def __init__(self, message):
+        # Passing the message up lets the exception be pickled and sent back from another process.
+        super().__init__(message)
         self.message = message
 
 
@@ -34,6 +42,7 @@ class MIFFParse(IFFParse):
     Exceptions for when parsing a MIFF file fails.
     """
     def __init__(self, message):
+        super().__init__(message)
         self.message = message
 
 
@@ -44,7 +53,7 @@ def check_file(input_data, input_type):
     Untested with some of the weirder versions of SC2k, such as Amiga, PocketPC/Windows Mobile, etc.
     Currently only supports parsing for FORM and MIFF files.
     Args:
-        input_data (bytes): bytes containing the entirety of the city.
+        input_data (bytes): bytes containing the entirety of the city. Can also be a memoryview.
         input_type (str): type of input file, supported are 'mif' for .mif tileset/MIFF file and 'sc2' for .sc2 city file.
     Returns:
         A tuple containing a dictionary and the input.
@@ -58,11 +67,11 @@ def check_file(input_data, input_type):
     if mac_check(input_data):
         input_data, city_name = mac_fix(input_data)
     # This should be "FORM" for .sc2
-    header = input_data[0 : 4]
+    header = bytes(input_data[0 : 4])
     # The reported size saved in the .sc2, we don't count the first 8 bytes though, so we need to add them back.
     reported_size = parse_int32(input_data[4 : 8]) + 8
     # This should be "SCDH"
-    file_type = input_data[8 : 12]
+    file_type = bytes(input_data[8 : 12])
     # Actual size of our input file
     actual_size = len(input_data)
     # Check and see if this is a Simcity Classic city.
@@ -120,23 +129,84 @@ def mac_fix(input_data):
     """
     reported_size = parse_int32(input_data[0x84 : 0x88]) + 8
     name_len = input_data[1]
-    city_name = input_data[1 : 2 + name_len]
+    city_name = bytes(input_data[1 : 2 + name_len])
     return input_data[0x80 : 0x80 + reported_size], city_name
 
 
+def probe_file(input_filename):
+    """
+    Quickly works out what kind of file this is, by only reading its first 0x90 bytes.
+    Meant as a pre-filter when scanning lots of files, before doing a full parse.
+    Unlike check_file(), this never raises on a bad file, it reports the problem instead, including a file that can't be read at all.
+    Args:
+        input_filename (path): path to the file to check.
+    Returns:
+        A dictionary that looks like {'file_type': file_type, 'valid': valid, 'data_size': reported_size, 'file_size': file_size, 'error': error_message}.
+        file_type is one of 'sc2' (Win95 city), 'mac_sc2' (Mac city), 'mif' (tileset/MIFF file), 'classic' (SimCity Classic city) or 'invalid'.
+        reported_size is the size the file claims to be (for a Mac file, this is the size of the contained Win95 file) and file_size is the size on disk, or None if it couldn't be read.
+        error_message is None if the file is valid.
+    """
+    probe = {'file_type': 'invalid', 'valid': False, 'data_size': None, 'file_size': None, 'error': None}
+    try:
+        file_size = os.path.getsize(input_filename)
+        with open(input_filename, 'rb') as f:
+            header_data = f.read(0x90)
+    except OSError as e:
+        probe['error'] = f"Couldn't read file: {e}"
+        return probe
+    probe['file_size'] = file_size
+    if len(header_data) < 12:
+        probe['error'] = f"File is too short, only {file_size}B long."
+        return probe
+    header = header_data[0 : 4]
+    mac_file = mac_check(header_data)
+    if mac_file:
+        # There's a 0x80 byte resource fork header before the actual city, which may also have trailing garbage.
+        header_data = header_data[0x80 : ]
+        header = header_data[0 : 4]
+    reported_size = parse_int32(header_data[4 : 8]) + 8
+    file_type = header_data[8 : 12]
+    probe['data_size'] = reported_size
+    if header == b"FORM" and file_type == b"SCDH":
+        if mac_file:
+            probe['file_type'] = 'mac_sc2'
+            # The Mac file can only be longer than what it contains.
+            size_ok = reported_size <= file_size - 0x80
+        else:
+            probe['file_type'] = 'sc2'
+            size_ok = reported_size == file_size
+    elif header == b"MIFF" and file_type == b"SC2K":
+        probe['file_type'] = 'mif'
+        size_ok = reported_size == file_size
+    elif header_data[0x41 : 0x49] == b'\x43\x49\x54\x59\x4D\x43\x52\x50' and header[0 : 2] == b'\x00\x0d':
+        probe['file_type'] = 'classic'
+        probe['data_size'] = None
+        probe['error'] = "Simcity Classic city files are not supported."
+        return probe
+    else:
+        probe['data_size'] = None
+        probe['error'] = f"Not a FORM or MIFF type IFF file, claiming: {header} {file_type}"
+        return probe
+    if not size_ok:
+        probe['error'] = f"File reports being: {reported_size}B, but is actually {file_size}B long."
+        return probe
+    probe['valid'] = True
+    return probe
+
+
 # Functions to handle chunking up the IFF file.
 def get_chunk_from_offset(input_data, offset):
     """
     Parses an IFF chunk by reading the header and using the size to determine which bytes belong to it.
     An IFF chunk has an 8 byte header, of which the first 4 bytes is the type and the second 4 bytes is the size (exclusive of the header).
     Args:
-        input_data (bytes): raw city information.
+        input_data (bytes): raw city information. If this is a memoryview, the chunk data is too, and isn't copied.
         offset (int): starting offset in input to start parsing at.
     Returns:
         A list containing the id of the chunk (a 4 byte ascii value), an int length of the chunk of finally bytes of the chunk data.
     """
     location_index = offset
-    chunk_id = input_data[location_index : location_index + 4].decode('ascii')
+    chunk_id = bytes(input_data[location_index : location_index + 4]).decode('ascii')
     # Maximum 32b/4B, so 2^32 in length.
     chunk_size = parse_uint32(input_data[location_index + 4 : location_index + 8])
     chunk_data = input_data[location_index + 8 : location_index + 8 + chunk_size]
@@ -173,9 +243,46 @@ def get_n_bytes(iterable, n, fill=None):
 
 
 # Functions to handle compression and decompression of the IFF file.
-def uncompress_rle(encoded_data):
+def uncompress_rle(encoded_data, check=False):
     """
     Uncompresses the RLE compressed city data. For more information, consult the .sc2 file format specification documents at https://github.com/dfloer/SC2k-docs
+    This works a run at a time instead of a byte at a time: literal runs are copied as a single slice and repeat runs are expanded with a single multiplication.
+    Malformed input (0x80 markers, truncated runs) is handled the same way as uncompress_rle_reference() handles it.
+    Args:
+        encoded_data (bytes): raw city information. Any bytes-like object works, including a memoryview into a memory mapped file.
+        check (bool): if True, also decode with uncompress_rle_reference() and fall back to its output if the two differ.
+    Returns:
+        Uncompressed bytes.
+    """
+    decoded_data = bytearray()
+    data_len = len(encoded_data)
+    idx = 0
+    while idx < data_len:
+        byte = encoded_data[idx]
+        if byte < 0x80:
+            # byte is a count of the number of data bytes that follow.
+            decoded_data += encoded_data[idx + 1 : idx + 1 + byte]
+            idx += byte + 1
+        elif byte > 0x80:
+            # byte-127=count of how many times the very next byte repeats.
+            if idx + 1 < data_len:
+                decoded_data += bytes((encoded_data[idx + 1], )) * (byte - 0x7f)
+            idx += 2
+        else:
+            # 0x80 isn't a valid run header, and is skipped.
+            idx += 1
+    if check:
+        reference_data = uncompress_rle_reference(encoded_data)
+        if reference_data != decoded_data:
+            print(f"RLE decoding mismatch, got {len(decoded_data)}B but expected {len(reference_data)}B. Using reference decoder output.")
+            return reference_data
+    return decoded_data
+
+
+def uncompress_rle_reference(encoded_data):
+    """
+    Reference implementation of uncompress_rle(), that works one byte at a time.
+    This is much slower, and is kept around to check the output of uncompress_rle() against.
     Args:
         encoded_data (bytes): raw city information.
     Returns:
@@ -205,9 +312,101 @@ def uncompress_rle(encoded_data):
     return decoded_data
 
 
-def compress_rle(uncompressed_data):
+def compress_rle(uncompressed_data, optimal=False):
     """
     Compresses city data with a generally comparable algorithm as SC2k uses stock. See .sc2 file spec for full details at https://github.com/dfloer/SC2k-docs
+    This is done in a single pass, writing straight into the output buffer, and produces the same bytes as compress_rle_reference().
+    Runs of 2 or more repeated bytes are found by a regex, so the bytes between them are all copied as literal runs.
+    Args:
+        uncompressed_data (bytes): Uncompressed data
+        optimal (bool): if True, use compress_rle_optimal() to get the smallest possible output instead.
+    Returns:
+        Compressed bytes.
+    """
+    if optimal:
+        return compress_rle_optimal(uncompressed_data)
+    compressed_data = bytearray()
+    # Start of the literal bytes that haven't been written out yet.
+    literal_start = 0
+    for run in REPEAT_RUN_PATTERN.finditer(uncompressed_data):
+        run_start, run_end = run.span()
+        # Everything between the previous repeat run and this one is written as literal runs of at most 127 bytes.
+        for offset in range(literal_start, run_start, 127):
+            literal = uncompressed_data[offset : min(offset + 127, run_start)]
+            compressed_data.append(len(literal))
+            compressed_data += literal
+        byte = uncompressed_data[run_start]
+        # Break runs up into the maximum number of consecutive bytes allowed.
+        full_runs, leftover = divmod(run_end - run_start, 128)
+        compressed_data += bytes((0xff, byte)) * full_runs
+        if leftover > 1:
+            compressed_data += bytes((leftover + 0x7f, byte))
+            literal_start = run_end
+        else:
+            # A single byte left over starts the next literal run.
+            literal_start = run_end - leftover
+    for offset in range(literal_start, len(uncompressed_data), 127):
+        literal = uncompressed_data[offset : offset + 127]
+        compressed_data.append(len(literal))
+        compressed_data += literal
+    return compressed_data
+
+
+def compress_rle_optimal(uncompressed_data):
+    """
+    Compresses city data into the smallest possible RLE encoding, using dynamic programming.
+    compress_rle() always encodes a run of 2 or more bytes as a repeat run, even when folding it into the surrounding literal run would be smaller.
+    Only literal runs of 1-127 bytes and repeat runs of 2-128 bytes are used, so the output can still be read by the game.
+    Args:
+        uncompressed_data (bytes): Uncompressed data
+    Returns:
+        Compressed bytes.
+    """
+    data_len = len(uncompressed_data)
+    # How many times the byte at each offset repeats, starting at that offset.
+    repeat_len = [1] * (data_len + 1)
+    for idx in range(data_len - 2, -1, -1):
+        if uncompressed_data[idx] == uncompressed_data[idx + 1]:
+            repeat_len[idx] = repeat_len[idx + 1] + 1
+    # min_size[x] is the smallest encoded size of uncompressed_data[x:], and next_offset[x] is where the run starting at x ends.
+    min_size = [0] * (data_len + 1)
+    next_offset = [data_len] * (data_len + 1)
+    is_repeat = [False] * (data_len + 1)
+    # Candidate literal run ends, kept so that their (offset + min_size) increases from front to back.
+    literal_ends = collections.deque([data_len])
+    for idx in range(data_len - 1, -1, -1):
+        # A literal run from idx to end costs 1 + (end - idx) + min_size[end], so pick the end minimising end + min_size[end].
+        if literal_ends[0] > idx + 127:
+            literal_ends.popleft()
+        best_end = literal_ends[0]
+        min_size[idx] = 1 + best_end - idx + min_size[best_end]
+        next_offset[idx] = best_end
+        # min_size never increases with the offset, so a repeat run may as well be as long as possible.
+        run_length = min(repeat_len[idx], 128)
+        if run_length > 1 and 2 + min_size[idx + run_length] < min_size[idx]:
+            min_size[idx] = 2 + min_size[idx + run_length]
+            next_offset[idx] = idx + run_length
+            is_repeat[idx] = True
+        while literal_ends and literal_ends[-1] + min_size[literal_ends[-1]] >= idx + min_size[idx]:
+            literal_ends.pop()
+        literal_ends.append(idx)
+    compressed_data = bytearray()
+    idx = 0
+    while idx < data_len:
+        end = next_offset[idx]
+        if is_repeat[idx]:
+            compressed_data += bytes((end - idx + 0x7f, uncompressed_data[idx]))
+        else:
+            compressed_data.append(end - idx)
+            compressed_data += uncompressed_data[idx : end]
+        idx = end
+    return compressed_data
+
+
+def compress_rle_reference(uncompressed_data):
+    """
+    Reference implementation of compress_rle(), that builds lists of the runs before encoding them.
+    This is much slower, and is kept around to check the output of compress_rle() against.
     Args:
         uncompressed_data (bytes): Uncompressed data
     Returns:
@@ -325,6 +524,215 @@ def sc2_uncompress_input(input_file, input_type='sc2'):
     return uncompressed_dict
 
 
+def sc2_compress_output(uncompressed_dict, input_type='sc2', optimal=False):
+    """
+    Compresses the chunks of a .mif or .sc2 file, the inverse of sc2_uncompress_input().
+    For a .sc2 file, doesn't compress chunks with id of CNAM, ALTM or the scenario chunks and for .mif, doesn't compress TILE chunks.
+    Args:
+        uncompressed_dict (dict): uncompressed {chunk id: chunk data} form, one entry per chunk.
+        input_type (str): type of the file we're writing.
+        optimal (bool): if True, compress to the smallest size possible. Slower, but still readable by the game.
+    Returns:
+        A dictionary of compressed {chunk id: chunk data} form, one entry per chunk.
+    """
+    compressed_dict = collections.OrderedDict()
+    for k, v in uncompressed_dict.items():
+        if input_type == 'sc2':
+            if k not in ("CNAM", "ALTM", "TEXT", "SCEN", "PICT"):
+                compressed_dict[k] = compress_rle(v, optimal)
+            else:
+                compressed_dict[k] = v
+        elif input_type == 'mif':
+            if k != "TILE":
+                compressed_dict[k] = compress_rle(v, optimal)
+            else:
+                compressed_dict[k] = v
+    return compressed_dict
+
+
+class ChunkDirectory(collections.abc.MutableMapping):
+    """
+    Lazy alternative to chunk_input_serial() followed by sc2_uncompress_input().
+    Only the IFF chunk headers are scanned up front, recording the id, offset and size of each chunk.
+    A chunk is only sliced out and uncompressed the first time it's accessed, and the result is cached.
+    Behaves like the dictionary returned by sc2_uncompress_input(), including TEXT being a list of chunks.
+    If the input is a memoryview, such as from open_file_mmap(), the raw chunks are memoryview slices and nothing is copied until a chunk is uncompressed.
+    """
+    def __init__(self, input_data, input_type='sc2'):
+        """
+        Args:
+            input_data (bytes): raw contents of the file, or a memoryview of them.
+            input_type (str): type of the input file we're opening.
+        Raises:
+            SC2Parse: re-raised errors from check_file()
+        """
+        self.input_type = input_type
+        self.header, self.input_data = check_file(input_data, input_type)
+        # {chunk id: (offset, size)}, with TEXT being a list of (offset, size) tuples.
+        self.chunks = collections.OrderedDict()
+        self._cache = {}
+        if self.header["city_name"] is not None:
+            self.chunks["CNAM"] = None
+            self._cache["CNAM"] = bytearray(self.header["city_name"])
+        file_length = self.header['data_size']
+        # Skip the 12B header.
+        offset = 12
+        while offset < file_length:
+            chunk_id = bytes(self.input_data[offset : offset + 4]).decode('ascii')
+            chunk_size = parse_uint32(self.input_data[offset + 4 : offset + 8])
+            entry = (offset + 8, chunk_size)
+            if chunk_id == "TEXT":
+                self.chunks.setdefault(chunk_id, []).append(entry)
+            else:
+                self.chunks[chunk_id] = entry
+                self._cache.pop(chunk_id, None)
+            offset += chunk_size + 8
+
+    @classmethod
+    def from_file(cls, input_filename, input_type='sc2', use_mmap=False):
+        """
+        Opens a file and creates a chunk directory for it.
+        Args:
+            input_filename (path): path to the file to open.
+            input_type (str): type of the input file we're opening.
+            use_mmap (bool): if True, memory map the file instead of reading all of it into memory.
+                Note that the file stays mapped for as long as the chunk directory is around.
+        Returns:
+            ChunkDirectory for the file.
+        """
+        if use_mmap:
+            raw_file = open_file_mmap(input_filename)
+        else:
+            raw_file = open_file(input_filename)
+        return cls(raw_file, input_type)
+
+    def get_raw(self, chunk_id):
+        """
+        Gets the raw, still compressed, data of a chunk.
+        Args:
+            chunk_id (str): id of the chunk, like "MISC".
+        Returns:
+            Bytes of the chunk, or a list of them for TEXT. These are memoryview slices if the input was a memoryview.
+        """
+        entry = self.chunks[chunk_id]
+        if entry is None:
+            return self._cache[chunk_id]
+        if chunk_id == "TEXT":
+            return [self.input_data[offset : offset + size] for offset, size in entry]
+        offset, size = entry
+        return self.input_data[offset : offset + size]
+
+    def is_compressed(self, chunk_id):
+        """
+        Checks if a chunk is stored RLE compressed, using the same rules as sc2_uncompress_input().
+        Args:
+            chunk_id (str): id of the chunk, like "MISC".
+        Returns:
+            True if the chunk needs to be uncompressed, False if it doesn't.
+        """
+        if self.input_type == 'sc2':
+            return chunk_id not in ("CNAM", "ALTM", "TEXT", "SCEN", "PICT")
+        return chunk_id != "TILE"
+
+    def is_loaded(self, chunk_id):
+        """
+        Checks if a chunk has already been uncompressed, so that getting it is free.
+        Args:
+            chunk_id (str): id of the chunk, like "MISC".
+        Returns:
+            True if the chunk has been uncompressed, False if it hasn't.
+        """
+        return chunk_id in self._cache
+
+    def __getitem__(self, chunk_id):
+        try:
+            return self._cache[chunk_id]
+        except KeyError:
+            pass
+        raw_data = self.get_raw(chunk_id)
+        if chunk_id == "TEXT" and self.input_type == 'sc2':
+            data = [bytearray(x) for x in raw_data]
+        elif self.is_compressed(chunk_id):
+            data = uncompress_rle(raw_data)
+        else:
+            data = bytearray(raw_data)
+        self._cache[chunk_id] = data
+        return data
+
+    def __setitem__(self, chunk_id, data):
+        if chunk_id not in self.chunks:
+            self.chunks[chunk_id] = None
+        self._cache[chunk_id] = data
+
+    def __delitem__(self, chunk_id):
+        del self.chunks[chunk_id]
+        self._cache.pop(chunk_id, None)
+
+    def __contains__(self, chunk_id):
+        # Without this, Mapping checks by getting the chunk, which uncompresses it.
+        return chunk_id in self.chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        return len(self.chunks)
+
+
+def open_and_uncompress_file(input_filename, input_type='sc2'):
+    """
+    Opens a file and uncompresses all of its chunks.
+    Errors are returned rather than raised, so that this can be used in a process pool without one bad file stopping the rest.
+    Args:
+        input_filename (path): path to the file to open.
+        input_type (str): type of the input file we're opening.
+    Returns:
+        A tuple of (input_filename, uncompressed data, error).
+        Uncompressed data is a dictionary of {chunk id: chunk data} form, as from sc2_uncompress_input(), or None if there was an error.
+        Error is the exception raised while opening or uncompressing the file, or None if there wasn't one.
+    """
+    try:
+        chunks = ChunkDirectory.from_file(input_filename, input_type)
+        uncompressed_data = collections.OrderedDict(chunks.items())
+    except Exception as e:
+        return input_filename, None, e
+    return input_filename, uncompressed_data, None
+
+
+def uncompress_files(input_filenames, input_type='sc2', max_workers=None, max_in_flight=None):
+    """
+    Opens and uncompresses a batch of files in parallel over a pool of processes.
+    Results are yielded as soon as each file is done, so they won't necessarily be in the same order as the input.
+    Args:
+        input_filenames (iterable): paths of the files to open.
+        input_type (str): type of the input files we're opening.
+        max_workers (int): number of processes to use, defaults to the number of CPUs.
+        max_in_flight (int): maximum number of files being worked on or waiting to be yielded at once, which bounds memory use. Defaults to twice the number of processes.
+    Yields:
+        A tuple of (input_filename, uncompressed data, error) for each file, as from open_and_uncompress_file().
+        A file that fails to parse, for example with SC2Parse, has an error and no data and doesn't stop the rest of the batch.
+    Raises:
+        ValueError: if max_in_flight is less than 1, as no files would ever be opened.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+    if max_in_flight < 1:
+        raise ValueError(f"max_in_flight must be at least 1, not {max_in_flight}.")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        filenames = iter(input_filenames)
+        in_flight = set()
+        while True:
+            for input_filename in itertools.islice(filenames, max_in_flight - len(in_flight)):
+                in_flight.add(executor.submit(open_and_uncompress_file, input_filename, input_type))
+            if not in_flight:
+                break
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
 def mif_parse_tile(tile_data):
     """
     Splits a .mif file into a list of tiles for further parsing.
@@ -2,12 +2,19 @@ import sc2_iff_parse as sc2p
 import sc2_serialize as sc2s
 import image_serialize as imgser
 import image_parse as imgp
+import array
 import collections
-from utils import parse_int32, parse_uint32, parse_uint16, parse_uint8, int_to_bitstring, int_to_bytes, bytes_to_hex, bytes_to_uint, bytes_to_int32s
-from utils import serialize_int32, serialize_uint32, uint_to_bytes
+import contextlib
+from utils import parse_int32, parse_uint8, int_to_bitstring, int_to_bytes, bytes_to_hex, bytes_to_uint
+from utils import serialize_int32, serialize_uint32, uint_to_bytes, or_bytes, open_temp_file
+import io
+import os
 import os.path
+import re
+import shutil
 import Data.buildings as buildings
-from copy import deepcopy
+import Data.misc_layout as misc_layout
+from copy import copy, deepcopy
 
 from struct import unpack, pack
 
@@ -29,19 +36,67 @@ class City:
     _invention_names = ['gas_power', 'nuclear_power', 'solar_power', 'wind_power', 'microwave_power', 'fusion_power',
                         'airport', 'highways', 'buses', 'subways', 'water_treatment', 'desalinisation', 'plymouth',
                         'forest', 'darco', 'launch', 'highway_2']
-
-    def __init__(self):
+    # bytes.translate() tables for splitting the fields out of a whole map of ALTM or XZON bytes at once.
+    # ALTM is a big endian uint16 per tile: tunnel in bits 11-15, water depth in bits 5-9 and altitude in bits 0-4.
+    _altm_tunnel_table = bytes(x >> 3 for x in range(256))
+    _altm_depth_high_table = bytes((x & 0x03) << 3 for x in range(256))
+    _altm_depth_low_table = bytes(x >> 5 for x in range(256))
+    _altm_altitude_table = bytes(x & 0x1F for x in range(256))
+    # XZON is a byte per tile: corners in the top 4 bits and zone in the bottom 4 bits.
+    _xzon_corners_table = bytes(x >> 4 for x in range(256))
+    _xzon_zone_table = bytes(x & 0x0F for x in range(256))
+    _zone_corners_strings = tuple(f"{x:04b}" for x in range(16))
+    _minimap_chunk_names = {'XTRF': 'traffic', 'XPLT': 'pollution', 'XVAL': 'value', 'XCRM': 'crime', 'XPLC': 'police',
+                            'XFIR': 'fire', 'XPOP': 'density', 'XROG': 'growth'}
+    # The attributes set by parsing each section of a city file, in the order the sections are parsed.
+    _section_attributes = {
+        'minimaps': tuple(_minimap_chunk_names.values()),
+        'tiles': ('tilelist', ),
+        'misc': ('city_attributes', 'budget', 'neighbor_info', 'building_count', 'simulator_settings', 'game_settings',
+                 'inventions', 'population_graphs', 'industry_graphs'),
+        'buildings': ('buildings', 'networks', 'groundcover', 'building_list', 'building_raster'),
+        'labels': ('labels', ),
+        'microsim': ('microsim_state', ),
+        'things': ('things', ),
+        'graphs': ('graphs', ),
+        'scenario': ('scenario', ),
+    }
+    # Sections that are parsed along with another section, because they change its attributes.
+    # find_buildings() is what puts the Buildings on the tiles, so the tiles aren't complete without it.
+    _section_dependents = {'tiles': ('buildings', )}
+    # {attribute: function to copy it} for the attributes that a snapshot() shares with its city until they're accessed.
+    # The building dicts are copied, but not the buildings in them, because the tiles refer to the same Building objects.
+    _snapshot_shared_attributes = {name: copy if section_name == 'buildings' else deepcopy for section_name, attribute_names in _section_attributes.items()
+                                   if section_name not in ('minimaps', 'tiles', 'labels') for name in attribute_names}
+
+    def __init__(self, columnar=False):
+        """
+        Args:
+            columnar (bool): if True, store the tiles in a TileLayers, with one array per tile attribute, rather than a dictionary of Tile objects.
+        """
         self.city_name = ""
         self.labels = {}
         self.microsim_state = {}
         self.graph_data = {}
+        self.columnar = columnar
         self.tilelist = {}
         self.buildings = {}  # Note that this stores *only* buildings.
         self.networks = {}  # Stores roads, rails, powerlines and other things that are above ground networks.
         self.groundcover = {}  # Stores trees, rubble and radioactivity.
         self.things = {}
+        # Every Building found by find_buildings(), and {tile index: index into building_list} of the one on each tile, or -1.
+        self.building_list = []
+        self.building_raster = array.array('i')
+        # See the building_index property.
+        self._building_index = None
         self.city_size = 128
         self.graphs = {k: None for k in self._graph_window_graphs}
+        # Chunks that have been explicitly marked as changed since the city was last loaded or saved.
+        self.dirty_chunks = set()
+        # {chunk id: (uncompressed bytes, compressed bytes)} as of the last load or save.
+        self.chunk_cache = {}
+        # {chunk id: snapshot of the values the chunk is built from} for the tile and minimap chunks, as of the last load or save.
+        self.chunk_fingerprints = {}
 
         # Stuff from Misc
         self.city_attributes = {}
@@ -64,6 +119,10 @@ class City:
         self.fire = Minimap("fire", 32)
         self.density = Minimap("density", 32)
         self.growth = Minimap("growth", 32)
+        # Change notifications, see subscribe().
+        self.events = CityEvents()
+        for minimap_name in self._minimap_chunk_names.values():
+            getattr(self, minimap_name).events = self.events
 
         # Optional Scenario stuff
         self.scenario = None
@@ -79,38 +138,37 @@ class City:
         Args:
             raw_sc2_data (bytes): Uncompressed .sc2 file.
         """
-        # Minimaps that map 4 tiles to 1.
-        map_size = self.city_size // 2
-        for x in range(map_size):
-            for y in range(map_size):
-                tile_idx = x * map_size + y
-                tile_key = (x, y)
-                xtrf = raw_sc2_data["XTRF"][tile_idx: tile_idx + 1]
-                xplt = raw_sc2_data["XPLT"][tile_idx: tile_idx + 1]
-                xval = raw_sc2_data["XVAL"][tile_idx: tile_idx + 1]
-                xcrm = raw_sc2_data["XCRM"][tile_idx: tile_idx + 1]
-                self.traffic[tile_key] = parse_uint8(xtrf)
-                self.pollution[tile_key] = parse_uint8(xplt)
-                self.value[tile_key] = parse_uint8(xval)
-                self.crime[tile_key] = parse_uint8(xcrm)
-                if self.debug:
-                    print(f"{tile_key}: traffic: {parse_uint8(xtrf)}, pollution: {parse_uint8(xplt)}, land value: {parse_uint8(xval)}, crime: {parse_uint8(xcrm)}\n")
-        # Minimaps that map 16 tiles to 1.
-        map_size_small = self.city_size // 4
-        for x in range(map_size_small):
-            for y in range(map_size_small):
-                tile_idx = x * map_size_small + y
-                tile_key = (x, y)
-                xplc = raw_sc2_data["XPLC"][tile_idx: tile_idx + 1]
-                xfir = raw_sc2_data["XFIR"][tile_idx: tile_idx + 1]
-                xpop = raw_sc2_data["XPOP"][tile_idx: tile_idx + 1]
-                xrog = raw_sc2_data["XROG"][tile_idx: tile_idx + 1]
-                self.police[tile_key] = parse_uint8(xplc)
-                self.fire[tile_key] = parse_uint8(xfir)
-                self.density[tile_key] = parse_uint8(xpop)
-                self.growth[tile_key] = parse_uint8(xrog)
-                if self.debug:
-                    print(f"{tile_key}: police: {parse_uint8(xplc)}, fire: {parse_uint8(xfir)}, densitye: {parse_uint8(xpop)}, growth: {parse_uint8(xrog)}\n")
+        for chunk_name, minimap_name in self._minimap_chunk_names.items():
+            minimap = getattr(self, minimap_name)
+            minimap.load(raw_sc2_data[chunk_name])
+            if self.debug:
+                print(f"{minimap}")
+
+    def decode_tile_chunks(self, raw_sc2_data):
+        """
+        Decodes the per tile chunks for the whole map at once, rather than a tile at a time.
+        Args:
+            raw_sc2_data (bytes): Uncompressed .sc2 file.
+        Returns:
+            A dictionary of {tile attribute: row major bytes with the attribute's value for each tile}.
+            The attributes are named as in Tile, except that zone_corners is an int here, rather than a bit string.
+        """
+        num_tiles = self.city_size * self.city_size
+        altm = bytes(raw_sc2_data["ALTM"][ : num_tiles * 2])
+        altm_high = altm[0 : : 2]
+        altm_low = altm[1 : : 2]
+        xzon = bytes(raw_sc2_data["XZON"][ : num_tiles])
+        return {
+            'altidue_tunnel': altm_high.translate(self._altm_tunnel_table),
+            'water_depth': or_bytes(altm_high.translate(self._altm_depth_high_table), altm_low.translate(self._altm_depth_low_table)),
+            'altitude': altm_low.translate(self._altm_altitude_table),
+            'terrain': bytes(raw_sc2_data["XTER"][ : num_tiles]),
+            'zone_corners': xzon.translate(self._xzon_corners_table),
+            'zone': xzon.translate(self._xzon_zone_table),
+            'underground': bytes(raw_sc2_data["XUND"][ : num_tiles]),
+            'text_pointer': bytes(raw_sc2_data["XTXT"][ : num_tiles]),
+            'bit_flags': bytes(raw_sc2_data["XBIT"][ : num_tiles]),
+        }
 
     def create_tilelist(self, raw_sc2_data):
         """
@@ -118,44 +176,41 @@ class City:
         Args:
             raw_sc2_data (bytes): Uncompressed .sc2 file.
         """
-        for row in range(self.city_size):
-            for col in range(self.city_size):
-                tile = Tile(self.traffic, self.pollution, self.value, self.crime, self.police, self.fire,  self.density, self.growth, self.labels)
-                tile_idx = row * self.city_size + col
-                tile_coords = (row, col)
-                tile.coordinates = tile_coords
-                if self.debug:
-                    print(f"index: {tile_idx} at {tile_coords}")
-                # First start with parsing the terrain related features.
-                altm = raw_sc2_data["ALTM"][tile_idx * 2 : tile_idx * 2 + 2]
-                xter = raw_sc2_data["XTER"][tile_idx : tile_idx + 1]
-                altm_bits = int_to_bitstring(parse_uint16(altm), 16)
-                tile.water_depth = int(altm_bits[6 : 11], 2)
-                tile.altitude = int(altm_bits[11 : ], 2)
-                tile.terrain = parse_uint8(xter)
-                if self.debug:
-                    print(f"altm: {altm_bits}, xter: {tile.terrain}")
-                tile.altidue_tunnel = int(altm_bits[0 : 5], 2)
-                # Next parse city stuff.
-                # skip self.building for now, it's handled specially.
-                xzon = raw_sc2_data["XZON"][tile_idx : tile_idx + 1]
-                xzon_bits = int_to_bitstring(parse_uint8(xzon), 8)
-                tile.zone_corners = xzon_bits[0 : 4]
-                tile.zone = int(xzon_bits[4 : ], 2)
-                xund = raw_sc2_data["XUND"][tile_idx : tile_idx + 1]
-                tile.underground = parse_uint8(xund)
-                if self.debug:
-                    print(f"zone: {tile.zone}, corners: {tile.zone_corners}, underground: {tile.underground}")
-                # text/signs
-                xtxt = raw_sc2_data["XTXT"][tile_idx : tile_idx + 1]
-                tile.text_pointer = parse_uint8(xtxt)
-                # bit flags
-                xbit = raw_sc2_data["XBIT"][tile_idx : tile_idx + 1]
-                tile.bit_flags = BitFlags(parse_uint8(xbit))
-                if self.debug:
-                    print(f"text pointer: {tile.text_pointer}, bit flags: {tile.bit_flags}")
-                # Add the new tile to the tilelist
-                self.tilelist[(row, col)] = tile
+        self.build_tilelist(self.decode_tile_chunks(raw_sc2_data))
+
+    def build_tilelist(self, tile_values):
+        """
+        Creates the tilelist from decoded tile values.
+        Args:
+            tile_values (dict): {tile attribute: row major bytes with the attribute's value for each tile}, as from decode_tile_chunks().
+        """
+        if self.columnar:
+            minimaps = {name: getattr(self, name) for name in self._minimap_chunk_names.values()}
+            self.tilelist = TileLayers(self.city_size, minimaps, self.labels, self.events)
+            for layer_name, values in tile_values.items():
+                self.tilelist.layer(layer_name)[:] = values
+            return
+        zone_corners_strings = self._zone_corners_strings
+        tile_keys = ((row, col) for row in range(self.city_size) for col in range(self.city_size))
+        minimaps = (self.traffic, self.pollution, self.value, self.crime, self.police, self.fire, self.density, self.growth, self.labels)
+        for tile_coords, tunnel, depth, altitude, terrain, corners, zone, underground, text_pointer, flags in zip(tile_keys, *tile_values.values()):
+            tile = Tile(*minimaps)
+            tile.coordinates = tile_coords
+            tile.altidue_tunnel = tunnel
+            tile.water_depth = depth
+            tile.altitude = altitude
+            tile.terrain = terrain
+            # skip self.building for now, it's handled specially.
+            tile.zone_corners = zone_corners_strings[corners]
+            tile.zone = zone
+            tile.underground = underground
+            tile.text_pointer = text_pointer
+            tile.bit_flags = BitFlags(flags)
+            if self.debug:
+                print(f"Tile at {tile_coords}: altitude: {altitude}, depth: {depth}, terrain: {terrain}, zone: {zone}, corners: {tile.zone_corners}, underground: {underground}, text pointer: {text_pointer}, bit flags: {tile.bit_flags}")
+            self.tilelist[tile_coords] = tile
+        if self.events.observers:
+            self.watch_tiles()
 
     def parse_labels(self, xlab_segment):
         """
@@ -228,9 +283,16 @@ class City:
             Look for holes (from the magic eraser or other bugs in this building).
             Todo: find building either missing the left corner (rotation) or otherwise "broken" but still supported by the game.
             Buildings are stored as a dictionary, where a tile's xy coordinates are the key. Each tile of a building will point back to the same builiding object. This handles holes in the building.
+        The scan is done for the whole map at once, by translating XZON and XBLD into a byte per tile saying what, if anything, starts there.
+        Only those tiles are then visited, in the same order as a tile by tile scan, so later tiles replace earlier ones in the same way.
         Args:
             raw_sc2_data: Raw data for the city.
+        Returns:
+            The building raster, which is also stored in self.building_raster. See building_at().
         """
+        # The buildings are about to change all at once, so the index is built again when it's next used, rather than updated for every tile.
+        self.unsubscribe(self.update_building_index)
+        self._building_index = None
         # If the city has been rotated, then what is considered the left corrner changes.
         city_rotation = self.simulator_settings["Compass"]
         corner = {0: 0b1000, 1: 0b0001, 2: 0b0010, 3: 0b0100}
@@ -238,98 +300,405 @@ class City:
         if self.debug:
             print(f"City has rotation {city_rotation}.")
 
-        groundcover_ids = list(range(0x01, 0x0D + 1))
-        network_ids = list(range(0x0E, 0x6B + 1))
-        highway_2x2_ids = list(range(0x61, 0x6B + 1))
+        groundcover_ids = range(0x01, 0x0D + 1)
+        network_ids = range(0x0E, 0x6B + 1)
+        highway_2x2_ids = range(0x61, 0x6B + 1)
+        building_sizes = {k: v["size"] for k, v in buildings.tile_data.items()}
+        # Which tiles hold groundcover or networks, or start a building with their left corner.
+        tile_groundcover, tile_network, tile_corner = 1, 2, 4
+        xbld_table = bytes(tile_groundcover if x in groundcover_ids else tile_network if x in network_ids and x not in highway_2x2_ids else 0 for x in range(256))
+        xzon_table = bytes(tile_corner if (x >> 4) & left_corner else 0 for x in range(256))
 
+        num_tiles = self.city_size * self.city_size
         raw_xbld = raw_sc2_data["XBLD"]
-        for row in range(self.city_size):
-            for col in range(self.city_size):
-                # Find left corner.
-                zone_mask = self.tilelist[(row, col)].zone_corners
+        tile_kinds = or_bytes(bytes(raw_xbld[ : num_tiles]).translate(xbld_table), bytes(raw_sc2_data["XZON"][ : num_tiles]).translate(xzon_table))
+        self.building_list = []
+        self.building_raster = array.array('i', [-1]) * num_tiles
+        for match in re.finditer(b'[^\x00]', tile_kinds):
+            tile_idx = match.start()
+            row, col = divmod(tile_idx, self.city_size)
+            building_id = raw_xbld[tile_idx]
+            new_building = Building(building_id, (row, col))
+            building_idx = len(self.building_list)
+            self.building_list.append(new_building)
+            self.building_raster[tile_idx] = building_idx
+            if tile_kinds[tile_idx] & tile_corner:
+                self.buildings[(row, col)] = new_building
+                # Certain highway pieces are 2x2 buildings, but should only be in networks.
+                if building_id in network_ids:
+                    self.networks[(row, col)] = new_building
+                else:
+                    self.tilelist[(row, col)].building = new_building
+                building_size = building_sizes[building_id]
                 if self.debug:
-                    print(f"Checking building at: ({row}, {col})")
-                if int(zone_mask, 2) & left_corner:
-                    tile_idx = row * self.city_size + col
-                    building_id = raw_xbld[tile_idx]
-                    new_building = Building(building_id, (row, col))
-                    self.buildings[(row, col)] = new_building
-                    # Certain highway pieces are 2x2 buildings, but should only be in networks.
-                    if building_id in network_ids:
-                        self.networks[(row, col)] = new_building
-                    else:
-                        self.tilelist[(row, col)].building = new_building
-                    building_size = buildings.get_size(building_id)
-                    if self.debug:
-                        print(f"Found Building: {building_id} with size: {building_size} at ({row}, {col})")
-
-                    # Now we need to find the rest og the building.
-                    if building_size == 1:
-                        continue
-                    # The clamping to 127 is to deal with certain industrial 3x3 buildings that glitch out on the edge of the map.
-                    for building_x in range(row, min(row + building_size + 1, 127)):
-                        for building_y in range(col, col - building_size, -1):
-                            next_tile_idx = building_x * self.city_size + building_y
-                            new_building_id = raw_xbld[next_tile_idx]
-                            if new_building_id == building_id:
-                                # Certain highway pieces are 2x2 buildings, but should only be in networks.
-                                if building_id in network_ids:
-                                    self.networks[(building_x, building_y)] = new_building
-                                else:
-                                    self.tilelist[(building_x, building_y)].building = new_building
-                                if self.debug:
-                                    print(f"Added Building: {new_building_id} at ({building_x}, {building_y})")
+                    print(f"Found Building: {building_id} with size: {building_size} at ({row}, {col})")
+
+                # Now we need to find the rest og the building.
+                if building_size == 1:
+                    continue
+                # The clamping to 127 is to deal with certain industrial 3x3 buildings that glitch out on the edge of the map.
+                for building_x in range(row, min(row + building_size + 1, 127)):
+                    for building_y in range(col, col - building_size, -1):
+                        next_tile_idx = building_x * self.city_size + building_y
+                        new_building_id = raw_xbld[next_tile_idx]
+                        if new_building_id == building_id:
+                            # Certain highway pieces are 2x2 buildings, but should only be in networks.
+                            if building_id in network_ids:
+                                self.networks[(building_x, building_y)] = new_building
                             else:
-                                if self.debug:
-                                    print(f"Found hole at: ({building_x}, {building_y})")
-                                    # This should probably be handled, but not yet.
-                else:
-                    # Why are groundcover and networks treated differently?
-                    # Because it seems (seemed?) to add flexibility.
-                    tile_idx = row * self.city_size + col
-                    building_id = raw_xbld[tile_idx]
-                    if building_id in groundcover_ids:
-                        new_building = Building(building_id, (row, col))
-                        self.groundcover[(row, col)] = new_building
-                        self.tilelist[(row, col)].building = new_building
-                        if self.debug:
-                            print(f"Found groundcover: {building_id} at ({row}, {col})")
-                    # We've already added the highways to the network.
-                    elif building_id in network_ids and building_id not in highway_2x2_ids:
-                        new_building = Building(building_id, (row, col))
-                        self.networks[(row, col)] = new_building
-                        self.tilelist[(row, col)].building = new_building
-                        if self.debug:
-                            print(f"Found network: {building_id} at ({row}, {col})")
-                    else:
-                        if self.debug:
-                            print(f"Tile parsing fallthrough at ({row}, {col}) with id: {building_id}")
-                        pass
-
-
-
-    def create_city_from_file(self, city_path):
+                                self.tilelist[(building_x, building_y)].building = new_building
+                            if building_y >= 0:
+                                self.building_raster[next_tile_idx] = building_idx
+                            if self.debug:
+                                print(f"Added Building: {new_building_id} at ({building_x}, {building_y})")
+                        else:
+                            if self.debug:
+                                print(f"Found hole at: ({building_x}, {building_y})")
+                                # This should probably be handled, but not yet.
+            # Why are groundcover and networks treated differently?
+            # Because it seems (seemed?) to add flexibility.
+            elif tile_kinds[tile_idx] & tile_groundcover:
+                self.groundcover[(row, col)] = new_building
+                self.tilelist[(row, col)].building = new_building
+                if self.debug:
+                    print(f"Found groundcover: {building_id} at ({row}, {col})")
+            # We've already added the highways to the network.
+            else:
+                self.networks[(row, col)] = new_building
+                self.tilelist[(row, col)].building = new_building
+                if self.debug:
+                    print(f"Found network: {building_id} at ({row}, {col})")
+        return self.building_raster
+
+    @property
+    def building_index(self):
+        """
+        The buildings on the tiles by id, see BuildingIndex.
+        Built by index_buildings() the first time it's used, so loading a city doesn't pay for it.
+        """
+        if self._building_index is None:
+            self.index_buildings()
+        return self._building_index
+
+    def index_buildings(self):
+        """
+        Builds the building_index from the buildings on the tiles, and subscribes it to this city so that it's kept up to date as they change.
+        """
+        self.load_pending_section('buildings')
+        self.unsubscribe(self.update_building_index)
+        if isinstance(self.tilelist, TileLayers):
+            size = self.city_size
+            tile_buildings = ((divmod(idx, size), x) for idx, x in enumerate(self.tilelist.building) if x is not None)
+        else:
+            tile_buildings = ((k, v.building) for k, v in self.tilelist.items() if v.building is not None)
+        self._building_index = BuildingIndex(tile_buildings)
+        self.subscribe(self.update_building_index, ('building_placed', 'building_removed'))
+
+    def update_building_index(self, events):
+        """
+        Keeps the building_index up to date, see index_buildings().
+        Args:
+            events (list): building_placed and building_removed CityEvents.
+        """
+        self._building_index.update(events)
+
+    def building_at(self, key):
+        """
+        Looks up what was found on a tile by find_buildings(), without scanning for it again.
+        Args:
+            key (tuple): (row, col) of the tile.
+        Returns:
+            The Building, network or groundcover covering the tile when the city was loaded, or None if there wasn't anything there.
+        """
+        row, col = key
+        if not (0 <= row < self.city_size and 0 <= col < self.city_size):
+            raise KeyError(key)
+        building_idx = self.building_raster[row * self.city_size + col]
+        if building_idx == -1:
+            return None
+        return self.building_list[building_idx]
+
+    def create_city_from_file(self, city_path, lazy=False, cache=None):
         """
         Populates a city object from a .sc2 file.
         Args:
             city_path: Path
+            lazy (bool): if True, don't parse any of the sections of the city yet.
+                Instead, each section is parsed the first time one of its attributes is accessed, so only reading city_attributes never builds the tiles or buildings.
+                See _section_attributes for which attributes belong to which section, and _section_dependents for the sections parsed together.
+            cache (CityCache): if given, load the parsed city from this cache if the file's been parsed before, and add it to the cache if not.
+                This isn't used for lazy loads. The tiles and buildings of a cached city are only created when they're first accessed, see CityCache.
         Returns:
             Nothing, used to populate a city object from a file.
         """
-        uncompressed_city = self.open_and_uncompress_sc2_file(city_path)
+        self.create_city_from_data(self.open_and_uncompress_sc2_file(city_path), lazy, cache)
+
+    def create_city_from_data(self, uncompressed_city, lazy=False, cache=None):
+        """
+        Populates a city object from the contents of a .sc2 file that's already been opened, such as one stored in a replay archive.
+        Args:
+            uncompressed_city (ChunkDirectory): city data, as from open_and_uncompress_sc2_file().
+            lazy (bool): see create_city_from_file().
+            cache (CityCache): see create_city_from_file().
+        Returns:
+            Nothing, used to populate a city object.
+        """
         self.name_city(uncompressed_city)
-        self.create_minimaps(uncompressed_city)
-        self.create_tilelist(uncompressed_city)
-        self.parse_misc(uncompressed_city["MISC"])
-        self.find_buildings(uncompressed_city)
-        self.parse_labels(uncompressed_city["XLAB"])
-        self.parse_microsim(uncompressed_city["XMIC"])
-        self.parse_things(uncompressed_city["XTHG"])
-        self.parse_graphs(uncompressed_city["XGRP"])
-
-        # Check for scenario.
-        if all(x in uncompressed_city.keys() for x in ("TEXT", "SCEN", "PICT")):
-            self.scenario = Scenario(uncompressed_city)
+        if lazy:
+            self._raw_city = uncompressed_city
+            # Remove the attributes until their section is parsed, so that accessing them goes through __getattr__().
+            self._pending_sections = {}
+            for section_name, attribute_names in self._section_attributes.items():
+                self._pending_sections[section_name] = {x: self.__dict__.pop(x) for x in attribute_names}
+        elif cache is None or not cache.load_city(self, uncompressed_city):
+            for section_name in self._section_attributes:
+                self.parse_section(section_name, uncompressed_city)
+            if cache is not None:
+                cache.store_city(self, uncompressed_city)
+        self.cache_chunks(uncompressed_city)
+
+    def parse_section(self, section_name, uncompressed_city):
+        """
+        Parses one section of a city.
+        Args:
+            section_name (str): name of the section, one of the keys of _section_attributes.
+            uncompressed_city (ChunkDirectory): city data, as from open_and_uncompress_sc2_file().
+        """
+        if section_name == 'minimaps':
+            self.create_minimaps(uncompressed_city)
+        elif section_name == 'tiles':
+            self.create_tilelist(uncompressed_city)
+        elif section_name == 'misc':
+            self.parse_misc(uncompressed_city["MISC"])
+        elif section_name == 'buildings':
+            self.find_buildings(uncompressed_city)
+        elif section_name == 'labels':
+            self.parse_labels(uncompressed_city["XLAB"])
+        elif section_name == 'microsim':
+            self.parse_microsim(uncompressed_city["XMIC"])
+        elif section_name == 'things':
+            self.parse_things(uncompressed_city["XTHG"])
+        elif section_name == 'graphs':
+            self.parse_graphs(uncompressed_city["XGRP"])
+        elif section_name == 'scenario':
+            # Check for scenario.
+            if all(x in uncompressed_city.keys() for x in ("TEXT", "SCEN", "PICT")):
+                self.scenario = Scenario(uncompressed_city)
+
+    def load_pending_section(self, section_name):
+        """
+        Parses a section of a lazily loaded city, if it hasn't been already.
+        Args:
+            section_name (str): name of the section, one of the keys of _section_attributes.
+        """
+        pending_sections = self.__dict__.get('_pending_sections', {})
+        if section_name not in pending_sections:
+            return
+        self.__dict__.update(pending_sections.pop(section_name))
+        loader = self.__dict__.get('_section_loaders', {}).pop(section_name, None)
+        if loader is None:
+            self.parse_section(section_name, self._raw_city)
+        else:
+            loader()
+        for dependent_name in self._section_dependents.get(section_name, ()):
+            self.load_pending_section(dependent_name)
+        if not pending_sections:
+            # A dependent section may have been the last one, and already let go of it.
+            self.__dict__.pop('_raw_city', None)
+            self.__dict__.pop('_section_loaders', None)
+
+    def defer_section(self, section_name, loader):
+        """
+        Holds off on loading a section until one of its attributes is first accessed, the same way as a lazy load, but loads it with a function rather than by parsing the city file.
+        Used by CityCache to only create the Tile and Building objects of a cached city once they're needed.
+        Args:
+            section_name (str): name of the section, one of the keys of _section_attributes.
+            loader (function): called with no arguments to set the section's attributes.
+        """
+        pending_sections = self.__dict__.setdefault('_pending_sections', {})
+        pending_sections[section_name] = {x: self.__dict__.pop(x) for x in self._section_attributes[section_name]}
+        self.__dict__.setdefault('_section_loaders', {})[section_name] = loader
+
+    def load_all_sections(self):
+        """
+        Parses every section of a lazily loaded city that hasn't been already.
+        """
+        for section_name in list(self.__dict__.get('_pending_sections', {})):
+            self.load_pending_section(section_name)
+
+    def snapshot(self):
+        """
+        Creates a copy of this city for what-if edits, like rezoning or bulldozing, without copying all of its data up front.
+        Instead, the copy shares its data with this city, and each part is only copied once it's needed:
+            The minimaps and the tile layers of a columnar city are copied a layer at a time, the first time the layer is written to.
+            The other sections, like city_attributes or things, are copied the first time they're accessed on either city, because reads and writes to them can't be told apart.
+            The last city still sharing a section gets the original, rather than a copy.
+        A tilelist of Tile objects can't be shared, so for a city that isn't columnar, the tiles are copied straight away.
+        A lazily loaded city has all of its sections parsed first.
+        Returns:
+            The new City.
+        """
+        self.load_all_sections()
+        shared_attributes = self.__dict__.setdefault('_shared_attributes', {})
+        for name, copier in self._snapshot_shared_attributes.items():
+            if name in shared_attributes:
+                shared_attributes[name].holders += 1
+            else:
+                shared_attributes[name] = SharedAttribute(self.__dict__.pop(name), copier)
+        clone = type(self).__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        clone.__dict__.pop('_pending_sections', None)
+        clone.__dict__.pop('_section_loaders', None)
+        clone._shared_attributes = dict(shared_attributes)
+        minimaps = {name: getattr(self, name).snapshot() for name in self._minimap_chunk_names.values()}
+        clone.__dict__.update(minimaps)
+        clone.labels = dict(self.labels)
+        # Whatever is subscribed to this city's changes isn't interested in the snapshot's.
+        clone.events = CityEvents()
+        # The snapshot builds its own building_index if it's used, as keeping a copy up to date would mean watching all of its tiles.
+        clone._building_index = None
+        for minimap in minimaps.values():
+            minimap.events = clone.events
+        if isinstance(self.tilelist, TileLayers):
+            clone.tilelist = self.tilelist.snapshot(minimaps, clone.labels)
+            clone.tilelist.events = clone.events
+        else:
+            clone.tilelist = {key: tile.copy(minimaps, clone.labels) for key, tile in self.tilelist.items()}
+        clone.graph_data = dict(self.graph_data)
+        clone.dirty_chunks = set(self.dirty_chunks)
+        clone.chunk_cache = dict(self.chunk_cache)
+        clone.chunk_fingerprints = dict(self.chunk_fingerprints)
+        return clone
+
+    def __getattr__(self, name):
+        """
+        Only called when an attribute isn't found normally.
+        For a lazily loaded city, this means its section hasn't been parsed yet, and for a snapshot() it means the attribute is still shared.
+        """
+        shared_attributes = self.__dict__.get('_shared_attributes', {})
+        if name in shared_attributes:
+            value = shared_attributes.pop(name).take()
+            self.__dict__[name] = value
+            return value
+        for section_name, attributes in self.__dict__.get('_pending_sections', {}).items():
+            if name in attributes:
+                self.load_pending_section(section_name)
+                return getattr(self, name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def cache_chunks(self, uncompressed_city):
+        """
+        Remembers the compressed and uncompressed bytes of each chunk as loaded, and marks every chunk as clean.
+        When saving, chunks that haven't changed since reuse these bytes instead of being rebuilt and recompressed.
+        Chunks that haven't been uncompressed yet, like those of a lazy load, aren't uncompressed here, see cached_chunk_data().
+        Args:
+            uncompressed_city (ChunkDirectory): city data, as from open_and_uncompress_sc2_file().
+        """
+        self.chunk_cache = {}
+        for chunk_name in sc2p.SC2_SIZE_DICT.keys():
+            # CNAM is tiny and may have been generated by name_city(), so it's always rebuilt.
+            if chunk_name == "CNAM" or chunk_name in sc2p.SCENARIO_CHUNKS or chunk_name not in uncompressed_city:
+                continue
+            compressed_data = bytes(uncompressed_city.get_raw(chunk_name))
+            if uncompressed_city.is_loaded(chunk_name):
+                uncompressed_data = bytes(uncompressed_city[chunk_name])
+            elif uncompressed_city.is_compressed(chunk_name):
+                uncompressed_data = None
+            else:
+                uncompressed_data = compressed_data
+            self.chunk_cache[chunk_name] = (uncompressed_data, compressed_data)
+        self.chunk_fingerprints = {}
+        # Minimaps that haven't been parsed yet can't have changed, and taking their snapshot would parse them.
+        if 'minimaps' in self.__dict__.get('_pending_sections', {}):
+            self.dirty_chunks.clear()
+            return
+        for chunk_name in self.chunk_cache:
+            fingerprint = self.chunk_fingerprint(chunk_name)
+            if fingerprint is not None:
+                self.chunk_fingerprints[chunk_name] = fingerprint
+        self.dirty_chunks.clear()
+
+    def cached_chunk_data(self, chunk_name):
+        """
+        Gets the uncompressed bytes of a chunk as of the last load or save, uncompressing them the first time they're needed.
+        Args:
+            chunk_name (str): id of the chunk, like "XTER".
+        Returns:
+            The uncompressed bytes, or None if the chunk isn't cached.
+        """
+        cached = self.chunk_cache.get(chunk_name)
+        if cached is None:
+            return None
+        uncompressed_data, compressed_data = cached
+        if uncompressed_data is None:
+            uncompressed_data = bytes(sc2p.uncompress_rle(compressed_data))
+            self.chunk_cache[chunk_name] = (uncompressed_data, compressed_data)
+        return uncompressed_data
+
+    def chunk_fingerprint(self, chunk_name):
+        """
+        Takes a snapshot of the values a minimap chunk is built from.
+        This is cheaper than building the chunk, so comparing against the snapshot from the last load or save is how these chunks are checked for changes.
+        The per-tile chunks are all built in one fast pass by sc2_serialize.serialize_tiles(), so those are just rebuilt and compared instead.
+        Args:
+            chunk_name (str): id of the chunk, like "XTRF".
+        Returns:
+            The snapshot, or None if this isn't a minimap chunk.
+        """
+        if chunk_name in self._minimap_chunk_names:
+            return getattr(self, self._minimap_chunk_names[chunk_name]).tobytes()
+        return None
+
+    def bit_flag_mask(self, flag_name):
+        """
+        Gets one of the bit flags for every tile at once, for example to find every powered tile.
+        Args:
+            flag_name (str): name of the flag, like "powered".
+        Returns:
+            Row major bytes with 1 for each tile that has the flag set, and 0 for those that don't.
+        """
+        if isinstance(self.tilelist, TileLayers):
+            return self.tilelist.flag_mask(flag_name)
+        return BitFlags.map_mask(bytes(int(tile.bit_flags) for tile in self.tilelist.values()), flag_name)
+
+    def subscribe(self, callback, kinds=None):
+        """
+        Registers a function to be called with the changes made to this city, so that things worked out from the city, like indexes or render caches, can be updated as it changes.
+        See CityEvents for the changes that are notified.
+        Args:
+            callback (function): called with a list of CityEvents, either as each change is made, or all at once at the end of a CityEvents.batch().
+            kinds (iterable): kinds of event to be called for, like ('building_placed', 'building_removed'), or None for all of them.
+        """
+        self.events.subscribe(callback, kinds)
+        self.watch_tiles()
+
+    def unsubscribe(self, callback):
+        """
+        Stops a function registered with subscribe() from being called.
+        Args:
+            callback (function): function to remove.
+        """
+        self.events.unsubscribe(callback)
+
+    def watch_tiles(self):
+        """
+        Makes the Tile objects of a city that isn't columnar notify changes to their attributes, by turning them into ObservedTiles.
+        This is only done once there's something subscribed, so that setting tile attributes doesn't slow down otherwise.
+        """
+        if isinstance(self.tilelist, TileLayers):
+            return
+        for tile in self.tilelist.values():
+            if type(tile) is Tile:
+                tile.__class__ = ObservedTile
+            tile._events = self.events
+
+    def mark_dirty(self, *chunk_names):
+        """
+        Marks chunks as changed, so they get rebuilt on the next save even if they don't look like they've changed.
+        Args:
+            chunk_names (str): ids of the chunks that changed, like "XTRF".
+        """
+        self.dirty_chunks.update(chunk_names)
 
     def name_city(self, uncompressed_data):
         """
@@ -348,23 +717,23 @@ class City:
             city_name = '.'.join(self.original_filename.split('.')[: -1]).upper()
         self.city_name = city_name[:31]
 
-    def open_and_uncompress_sc2_file(self, city_file_path):
+    def open_and_uncompress_sc2_file(self, city_file_path, use_mmap=False):
         """
         Handles opening and decompression of a city file.
         Args:
             city_file_path: Path to the city file to be opened.
+            use_mmap (bool): if True, memory map the file rather than reading it all into memory.
         Returns:
             Uncompressed city data ready for parsing into something more usable.
-                This takes the form of a dictionary with the keys being the 4-letter chunk headers from the sc2 IFF file, and the values being the uncompressed raw binary data in bytearray from.
+                This takes the form of a ChunkDirectory, which acts as a dictionary with the keys being the 4-letter chunk headers from the sc2 IFF file, and the values being the uncompressed raw binary data in bytearray from.
+                Chunks are only uncompressed when they're first accessed.
         """
         _, filename = os.path.split(city_file_path)
         self.original_filename = filename
-        raw_sc2_file = sc2p.open_file(city_file_path)
         try:
-            compressed_data = sc2p.chunk_input_serial(raw_sc2_file, 'sc2')
+            uncompressed_data = sc2p.ChunkDirectory.from_file(city_file_path, 'sc2', use_mmap)
         except sc2p.SC2Parse:
             raise
-        uncompressed_data = sc2p.sc2_uncompress_input(compressed_data, 'sc2')
         return uncompressed_data
 
     def parse_misc(self, misc_data):
@@ -374,181 +743,39 @@ class City:
         Args:
             misc_data (bytes): MISC segment of the raw data from the .sc2 file.
         """
-        # This is the offset of the section that's being parsed from MISC.
-        parse_order = {
-            '0x0000': 'FirstEntry',  # nominally the same in every city.
-            '0x0004': 'GameMode',
-            '0x0008': 'Compass',  # rotation
-            '0x000c': 'baseYear',
-            '0x0010': 'simCycle',
-            '0x0014': 'TotalFunds',
-            '0x0018': 'TotalBonds',
-            '0x001c': 'GameLevel',
-            '0x0020': 'CityStatus',
-            '0x0024': 'CityValue',
-            '0x0028': 'LandValue',
-            '0x002c': 'CrimeCount',
-            '0x0030': 'TrafficCount',
-            '0x0034': 'Pollution',
-            '0x0038': 'CityFame',
-            '0x003c': 'Advertising',
-            '0x0040': 'Garbage',
-            '0x0044': 'WorkerPercent',
-            '0x0048': 'WorkerHealth',
-            '0x004c': 'WorkerEducate',
-            '0x0050': 'NationalPop',
-            '0x0054': 'NationalValue',
-            '0x0058': 'NationalTax',
-            '0x005c': 'NationalTrend',
-            '0x0060': 'heat',
-            '0x0064': 'wind',
-            '0x0068': 'humid',
-            '0x006c': 'weatherTrend',
-            '0x0070': 'NewDisaster',
-            '0x0074': 'oldResPop',
-            '0x0078': 'Rewards',
-            '0x007c': 'Population Graphs',
-            '0x016c': 'Industry Graphs',
-            '0x01f0': 'Tile Counts',
-            '0x05f0': 'ZonePop|0',
-            '0x05f4': 'ZonePop|1',
-            '0x05f8': 'ZonePop|2',
-            '0x05fc': 'ZonePop|3',
-            '0x0600': 'ZonePop|4',
-            '0x0604': 'ZonePop|5',
-            '0x0608': 'ZonePop|6',
-            '0x060c': 'ZonePop|7',
-            '0x0610': 'Bonds',
-            '0x06d8': 'Neighbours',
-            '0x0718': 'Valve?|0',  # reverse engineered from the game, may be a typo in original.
-            '0x071c': 'Valve?|1',
-            '0x0720': 'Valve?|2',
-            '0x0724': 'Valve?|3',
-            '0x0728': 'Valve?|4',
-            '0x072c': 'Valve?|5',
-            '0x0730': 'Valve?|6',
-            '0x0734': 'Valve?|7',
-            '0x0738': 'gas_power',
-            '0x073c': 'nuclear_power',
-            '0x0740': 'solar_power',
-            '0x0744': 'wind_power',
-            '0x0748': 'microwave_power',
-            '0x074c': 'fusion_power',
-            '0x0750': 'airport',
-            '0x0754': 'highways',
-            '0x0758': 'buses',
-            '0x075c': 'subways',
-            '0x0760': 'water_treatment',
-            '0x0764': 'desalinisation',
-            '0x0768': 'plymouth',
-            '0x076c': 'forest',
-            '0x0770': 'darco',
-            '0x0774': 'launch',
-            '0x0778': 'highway_2',
-            '0x077c': 'Budget',
-            '0x0e3c': 'YearEnd',
-            '0x0e40': 'GlobalSeaLevel',
-            '0x0e44': 'terCoast',
-            '0x0e48': 'terRiver',
-            '0x0e4c': 'Military',
-            '0x0e50': 'Paper List',
-            '0x0ec8': 'News List',
-            '0x0fa0': 'Ordinances',
-            '0x0fa4': 'unemployed',
-            '0x0fa8': 'Military Count',
-            '0x0fe8': 'SubwayCnt',
-            '0x0fec': 'GameSpeed',
-            '0x0ff0': 'AutoBudget',
-            '0x0ff4': 'AutoGo',
-            '0x0ff8': 'UserSoundOn',
-            '0x0ffc': 'UserMusicOn',
-            '0x1000': 'NoDisasters',
-            '0x1004': 'PaperDeliver',
-            '0x1008': 'PaperExtra',
-            '0x100c': 'PaperChoice',
-            '0x1010': 'unknown128',
-            '0x1014': 'Zoom',
-            '0x1018': 'CityCentX',
-            '0x101c': 'CityCentY',
-            '0x1020': 'GlobalArcoPop',
-            '0x1024': 'ConnectTiles',
-            '0x1028': 'TeamsActive',
-            '0x102c': 'TotalPop',
-            '0x1030': 'IndustryBonus',
-            '0x1034': 'PolluteBonus',
-            '0x1038': 'oldArrest',
-            '0x103c': 'PoliceBonus',
-            '0x1040': 'DisasterObject',
-            '0x1044': 'CurrentDisaster',
-            '0x1048': 'GoDisaster',
-            '0x104c': 'SewerBonus',
-            '0x1050': 'Extra', }
-        handle_special = ['Population Graphs', 'Industry Graphs', 'Tile Counts', 'Bonds', 'Neighbours', 'Budget',
-                          'Military Count', 'Paper List', 'News List', 'Extra', 'Ordinances'] + list(
-            self.simulator_settings.keys()) + list(self.game_settings.keys()) + list(self.inventions.keys())
-
-        # Make sure the dict is sorted because following code requires the sorting.
-        #sorted(parse_order.keys())
-
         # Parse misc and generate city attributes.
-        for k, v in parse_order.items():
-            offset = int(k, 16)
-            if v not in handle_special:
-                self.city_attributes[v] = parse_uint32(misc_data[offset : offset + 4])
-            elif v == 'Population Graphs':
-                length = 240
-                self.population_graphs = self.misc_uninterleave_data(self._population_graph_names, offset, length, misc_data)
-            elif v == 'Industry Graphs':
-                length = 132
-                self.industry_graphs = self.misc_uninterleave_data(self._industry_graph_names, offset, length, misc_data)
-            elif v == 'Tile Counts':
+        misc_fields = misc_layout.unpack_misc(misc_data)
+        for k, v in misc_fields.items():
+            if k == 'Population Graphs':
+                self.population_graphs = {x: list(v[idx : : len(self._population_graph_names)]) for idx, x in enumerate(self._population_graph_names)}
+            elif k == 'Industry Graphs':
+                self.industry_graphs = {x: list(v[idx : : len(self._industry_graph_names)]) for idx, x in enumerate(self._industry_graph_names)}
+            elif k == 'Tile Counts':
                 for x in range(0, 256):
-                    self.building_count[x] = parse_int32(misc_data[offset: offset + 4])
-                    offset += 4
-            elif v in ('Bonds', 'Ordinances'):
+                    self.building_count[x] = v[x]
+            elif k in ('Bonds', 'Ordinances'):
                 # Handled along with the budget.
                 continue
-            elif v == 'Neighbours':
+            elif k == 'Neighbours':
                 neighbour_types = ['Name', 'Population', 'Value', 'Fame']
-                # Calculate their offsets. 64 = 4 neighbours at 4 x 4B entries each
-                for idx, start_offset in enumerate(range(offset, offset + 64, 16)):
-                    # 16 = 4 entries x 4B per entry.
-                    neighbour = collections.OrderedDict()
-                    for x in range(start_offset, start_offset + 16, 4):
-                        type_key = neighbour_types[((x + 8) % 16) // 4]
-                        neighbour[type_key] = parse_int32(misc_data[x : x + 4])
-                    self.neighbor_info[idx] = neighbour
-            elif v == 'Budget':
+                # 4 neighbours with 4 entries each.
+                for idx in range(4):
+                    self.neighbor_info[idx] = collections.OrderedDict(zip(neighbour_types, v[idx * 4 : idx * 4 + 4]))
+            elif k == 'Budget':
                 self.budget = Budget()
-                self.budget.parse_budget(misc_data)
-            elif v == 'Military Count':
-                num_items = 16
-                for idx, x in enumerate(range(offset, offset + num_items * 4, 4)):
-                    key = "{}|{}".format(v, idx)
-                    self.city_attributes[key] = parse_int32(misc_data[x : x + 4])
-            elif v == 'Paper List':
-                num_items = 6 * 5
-                for idx, x in enumerate(range(offset, offset + num_items * 4, 4)):
-                    key = "{}|{}".format(v, idx)
-                    self.city_attributes[key] = parse_int32(misc_data[x : x + 4])
-            elif v == 'News List':
-                num_items = 9 * 6
-                for idx, x in enumerate(range(offset, offset + num_items * 4, 4)):
-                    key = "{}|{}".format(v, idx)
-                    self.city_attributes[key] = parse_int32(misc_data[x : x + 4])
-            elif v == 'Extra':
-                for idx, x in enumerate(range(offset, 4800, 4)):
-                    key = "{}|{}".format(v, idx)
-                    self.city_attributes[key] = parse_int32(misc_data[x : x + 4])
-            elif v in list(self.simulator_settings.keys()):
-                self.simulator_settings[v] = parse_int32(misc_data[offset : offset + 4])
-            elif v in list(self.game_settings.keys()):
-                self.game_settings[v] = parse_int32(misc_data[offset : offset + 4])
-            elif v in list(self.inventions.keys()):
-                self.inventions[v] = parse_int32(misc_data[offset : offset + 4])
+                self.budget.parse_budget_fields(misc_fields)
+            elif k in ('Military Count', 'Paper List', 'News List', 'Extra'):
+                for idx, x in enumerate(v):
+                    key = "{}|{}".format(k, idx)
+                    self.city_attributes[key] = x
+            elif k in self.simulator_settings:
+                self.simulator_settings[k] = v[0]
+            elif k in self.game_settings:
+                self.game_settings[k] = v[0]
+            elif k in self.inventions:
+                self.inventions[k] = v[0]
             else:
-                # Fallthrough, this should never, ever, be hit.
-                print("MISC is missing something!", k, v)
+                self.city_attributes[k] = v[0]
 
     def misc_uninterleave_data(self, keys, offset, length, misc_data):
         """
@@ -571,62 +798,271 @@ class City:
             output[key_name] = values[idx]
         return output
 
-    def serialize(self):
+    def serialize_segments(self, optimal=False):
+        """
+        Creates the compressed chunks of a .sc2 file to save, in the order they're saved in.
+        Args:
+            optimal (bool): if True, compress the segments to the smallest size possible, at the cost of a slower save.
+        Returns:
+            A list of (chunk id, chunk bytes) tuples, including the scenario chunks if there is a scenario.
+            This is a list rather than a dictionary because scenarios have two TEXT chunks.
+        """
+        # All of the per-tile chunks are built together, the first time one is needed.
+        tile_chunks = {}
+
+        def tile_chunk(chunk_name):
+            if not tile_chunks:
+                tile_chunks.update(sc2s.serialize_tiles(self))
+            return tile_chunks[chunk_name]
+
+        segments = (
+            ("CNAM", sc2s.name_to_cnam, (self.city_name, )),
+            ("MISC", sc2s.serialize_misc, (self, )),
+            ("ALTM", tile_chunk, ("ALTM", )),
+            ("XTER", tile_chunk, ("XTER", )),
+            ("XBLD", sc2s.serialize_building_data, (self, )),
+            ("XZON", tile_chunk, ("XZON", )),
+            ("XUND", tile_chunk, ("XUND", )),
+            ("XTXT", tile_chunk, ("XTXT", )),
+            ("XLAB", sc2s.serialize_labels, (self, )),
+            ("XMIC", sc2s.serialize_microsim, (self, )),
+            ("XTHG", sc2s.serialize_things, (self, )),
+            ("XBIT", tile_chunk, ("XBIT", )),
+            ("XTRF", sc2s.serialize_minimap, (self, "traffic")),
+            ("XPLT", sc2s.serialize_minimap, (self, "pollution")),
+            ("XVAL", sc2s.serialize_minimap, (self, "value")),
+            ("XCRM", sc2s.serialize_minimap, (self, "crime")),
+            ("XPLC", sc2s.serialize_minimap, (self, "police")),
+            ("XFIR", sc2s.serialize_minimap, (self, "fire")),
+            ("XPOP", sc2s.serialize_minimap, (self, "density")),
+            ("XROG", sc2s.serialize_minimap, (self, "growth")),
+            ("XGRP", sc2s.serialize_graphs, (self, )),
+        )
+        compressed_segments = collections.OrderedDict()
+        uncompressed_segments = collections.OrderedDict()
+        fingerprints = {}
+        for segment_name, serializer, args in segments:
+            # The cached chunks may not be optimally compressed, so they can't be used.
+            cached = None if optimal else self.chunk_cache.get(segment_name)
+            fingerprint = self.chunk_fingerprint(segment_name)
+            if fingerprint is not None:
+                fingerprints[segment_name] = fingerprint
+                # The values this chunk is built from are unchanged, so there's no need to rebuild it at all.
+                if cached and segment_name not in self.dirty_chunks and fingerprint == self.chunk_fingerprints.get(segment_name):
+                    compressed_segments[segment_name] = cached[1]
+                    continue
+            segment_data = serializer(*args)
+            if cached and self.cached_chunk_data(segment_name) == segment_data:
+                compressed_segments[segment_name] = cached[1]
+            else:
+                # Placeholder to keep the chunk order, filled in once compressed.
+                compressed_segments[segment_name] = None
+                uncompressed_segments[segment_name] = segment_data
+        for segment_name, segment_data in sc2p.sc2_compress_output(uncompressed_segments, 'sc2', optimal).items():
+            compressed_segments[segment_name] = segment_data
+            if segment_name != "CNAM":
+                self.chunk_cache[segment_name] = (bytes(uncompressed_segments[segment_name]), bytes(segment_data))
+        self.chunk_fingerprints.update(fingerprints)
+        self.dirty_chunks.clear()
+        return list(compressed_segments.items()) + sc2s.scenario_chunks(self)
+
+    def serialize(self, optimal=False):
         """
         Creates the bytes representing a .sc2 file to save.
+        Args:
+            optimal (bool): if True, compress the segments to the smallest size possible, at the cost of a slower save.
         Returns:
             Bytes representing a serialized .sc2 file to save.
         """
-        do_not_compress = ("CNAM", "ALTM")
-        uncompressed_segments = {}
-        uncompressed_segments["CNAM"] = sc2s.name_to_cnam(self.city_name)
-        uncompressed_segments["MISC"] = sc2s.serialize_misc(self)
-        uncompressed_segments["ALTM"] = sc2s.serialize_tile_data(self, "ALTM")
-        uncompressed_segments["XTER"] = sc2s.serialize_tile_data(self, "XTER")
-        uncompressed_segments["XBLD"] = sc2s.serialize_building_data(self)
-        uncompressed_segments["XZON"] = sc2s.serialize_tile_data(self, "XZON")
-        uncompressed_segments["XUND"] = sc2s.serialize_tile_data(self, "XUND")
-        uncompressed_segments["XTXT"] = sc2s.serialize_tile_data(self, "XTXT")
-        uncompressed_segments["XLAB"] = sc2s.serialize_labels(self)
-        uncompressed_segments["XMIC"] = sc2s.serialize_microsim(self)
-        uncompressed_segments["XTHG"] = sc2s.serialize_things(self)
-        uncompressed_segments["XBIT"] = sc2s.serialize_tile_data(self, "XBIT")
-        uncompressed_segments["XTRF"] = sc2s.serialize_minimap(self, "traffic")
-        uncompressed_segments["XPLT"] = sc2s.serialize_minimap(self, "pollution")
-        uncompressed_segments["XVAL"] = sc2s.serialize_minimap(self, "value")
-        uncompressed_segments["XCRM"] = sc2s.serialize_minimap(self, "crime")
-        uncompressed_segments["XPLC"] = sc2s.serialize_minimap(self, "police")
-        uncompressed_segments["XFIR"] = sc2s.serialize_minimap(self, "fire")
-        uncompressed_segments["XPOP"] = sc2s.serialize_minimap(self, "density")
-        uncompressed_segments["XROG"] = sc2s.serialize_minimap(self, "growth")
-        uncompressed_segments["XGRP"] = sc2s.serialize_graphs(self)
-        compressed_segments = {}
-        for segment_name, segment_data in uncompressed_segments.items():
-            if segment_name not in do_not_compress:
-                compressed_segments[segment_name] = sc2p.compress_rle(segment_data)
-            else:
-                compressed_segments[segment_name] = segment_data
-
-        output_bytes = sc2s.generate_header()
-        output_bytes += sc2s.serialize_chunks(compressed_segments)
-        if self.scenario:
-            scen_data = sc2s.serialize_scenario(self)
-            output_bytes += scen_data
+        output_file = io.BytesIO()
+        self.write_city(output_file, optimal)
+        return bytearray(output_file.getbuffer())
 
-        total_bytes = len(output_bytes) - 8  # FORM and length don't count.
-        output_bytes[4 : 8] = sc2s.serialize_int32(total_bytes)
-        return output_bytes
+    def write_city(self, output_file, optimal=False):
+        """
+        Streams this city as a .sc2 file to a binary file object, without building the whole file in memory first.
+        Args:
+            output_file (file): binary file object to write to. For a socket, use socket.makefile('wb').
+            optimal (bool): if True, compress the city to the smallest size possible.
+        Returns:
+            Number of bytes written.
+        """
+        return sc2s.write_chunks(output_file, self.serialize_segments(optimal), "SCDH")
 
-    def save_city(self, path):
+    def save_city(self, path, optimal=False, atomic=True):
         """
         Save this city to a given path.
         Args:
             path (str): path to save the city to.
+            optimal (bool): if True, compress the city to the smallest size possible.
+            atomic (bool): if True, write to a temporary file next to path, and then rename it over path.
+                This way, a crash part way through a save can't leave a half written city behind.
         Returns:
             Nothing, but saves the city at the given path.
         """
-        with open(path, 'wb') as f:
-            f.write(self.serialize())
+        if not atomic:
+            with open(path, 'wb') as f:
+                self.write_city(f, optimal)
+            return
+        temp_path, f = open_temp_file(path)
+        try:
+            with f:
+                self.write_city(f, optimal)
+                f.flush()
+                os.fsync(f.fileno())
+            # A new file keeps the permissions the temporary file was created with, but a replaced file keeps its own.
+            if os.path.exists(path):
+                shutil.copymode(path, temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+
+class SharedAttribute:
+    """
+    An attribute that's shared between a city and its snapshots, until each city accesses it.
+    """
+    def __init__(self, value, copier):
+        """
+        Args:
+            value: value of the attribute.
+            copier (function): function to copy the value with, like deepcopy.
+        """
+        self.value = value
+        self.copier = copier
+        # How many cities are still sharing the value.
+        self.holders = 2
+
+    def take(self):
+        """
+        Gets the value for one of the cities sharing it, which stops that city from sharing it.
+        Returns:
+            A copy of the value, or the value itself for the last city sharing it.
+        """
+        self.holders -= 1
+        if self.holders == 0:
+            return self.value
+        return self.copier(self.value)
+
+
+# A change to a city, as notified by CityEvents.
+CityEvent = collections.namedtuple('CityEvent', ['kind', 'layer', 'coords', 'old', 'new'])
+
+
+class CityEvents:
+    """
+    Notifies the changes made to a city to the functions subscribed to it, see City.subscribe().
+    Each change is a CityEvent, with kind being one of:
+        tile: a tile attribute changed. layer is the attribute, like "altitude", and coords is the (row, col) of the tile.
+            zone_corners is always a bit string, and bit_flags is always an int.
+        building_removed: a building was removed from a tile, with old being the Building. This is also a tile event for the "building" layer.
+        building_placed: a building was placed on a tile, with new being the Building. This is also a tile event for the "building" layer.
+        minimap: a minimap value changed. layer is the minimap, like "traffic", and coords is the (x, y) in minimap coordinates.
+            coords is None if the whole minimap was replaced.
+    Changes made by setting tile attributes, or through a Minimap's methods, are notified, but changes made straight to the underlying arrays, like TileLayers.layer(), aren't.
+    Those can be notified with emit() instead.
+    """
+    def __init__(self):
+        # (callback, kinds) of each subscriber, where kinds is a set of event kinds or None for all of them.
+        self.observers = []
+        # Events waiting to be delivered at the end of a batch(), or None outside of one.
+        self.pending = None
+
+    def subscribe(self, callback, kinds=None):
+        """
+        Args:
+            callback (function): called with a list of CityEvents.
+            kinds (iterable): kinds of event to be called for, or None for all of them.
+        """
+        self.observers.append((callback, None if kinds is None else set(kinds)))
+
+    def unsubscribe(self, callback):
+        """
+        Args:
+            callback (function): function to stop calling.
+        """
+        self.observers = [x for x in self.observers if x[0] != callback]
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Holds on to the changes made inside a with block, and delivers them all at once at the end, so subscribers can update once for many changes.
+        Nested batches are delivered at the end of the outermost one.
+        """
+        if self.pending is not None:
+            yield
+            return
+        self.pending = []
+        try:
+            yield
+        finally:
+            events, self.pending = self.pending, None
+            self.deliver(events)
+
+    def emit(self, *events):
+        """
+        Notifies changes, or holds on to them until the end of the current batch().
+        Args:
+            events (CityEvent): changes to notify.
+        """
+        if not self.observers:
+            return
+        if self.pending is not None:
+            self.pending.extend(events)
+        else:
+            self.deliver(events)
+
+    def deliver(self, events):
+        """
+        Calls each subscriber with the changes it's interested in.
+        Args:
+            events (list): CityEvents to deliver.
+        """
+        for callback, kinds in list(self.observers):
+            selected = list(events) if kinds is None else [x for x in events if x.kind in kinds]
+            if selected:
+                callback(selected)
+
+    def tile_changed(self, coords, layer_name, old, new):
+        """
+        Notifies a change to a tile attribute.
+        Args:
+            coords (tuple): (row, col) of the tile.
+            layer_name (str): name of the attribute.
+            old: value before the change.
+            new: value after the change.
+        """
+        if not self.observers:
+            return
+        if layer_name == 'zone_corners':
+            old, new = (f"{x:04b}" if isinstance(x, int) else x for x in (old, new))
+        elif layer_name == 'bit_flags':
+            old, new = (None if x is None else int(x) for x in (old, new))
+        if old == new:
+            return
+        events = [CityEvent('tile', layer_name, coords, old, new)]
+        if layer_name == 'building':
+            if old is not None:
+                events.append(CityEvent('building_removed', layer_name, coords, old, None))
+            if new is not None:
+                events.append(CityEvent('building_placed', layer_name, coords, None, new))
+        self.emit(*events)
+
+    def minimap_changed(self, minimap_name, coords, old, new):
+        """
+        Notifies a change to a minimap value.
+        Args:
+            minimap_name (str): name of the minimap, like "traffic".
+            coords (tuple): (x, y) minimap coordinates, or None if the whole minimap was replaced.
+            old (int): value before the change.
+            new (int): value after the change.
+        """
+        if self.observers:
+            self.emit(CityEvent('minimap', minimap_name, coords, old, new))
 
 
 class Building:
@@ -641,35 +1077,210 @@ class Building:
         return f"Building: {self.name} ({self.building_id}/0x{0xdc:02X}) at ({tile_x}, {tile_y})."
 
 
+class BuildingIndex:
+    """
+    Index of the buildings on a city's tiles by building id, so that finding every building of a kind, like every fire station or arcology, doesn't need a scan of the whole tilelist.
+    Queries take time in proportion to the number of buildings found, not the size of the city.
+    Each Building is recorded with the tiles it's on, which is its whole footprint unless it has holes in it.
+    Built by City.index_buildings() the first time City.building_index is used, which also keeps it up to date as buildings are placed and removed, see City.subscribe().
+    Note that the 2x2 highway pieces are only in City.networks, not on the tiles, so they aren't indexed.
+    """
+    # {zone: [building ids]} and {microsim: [building ids]}, from the building data.
+    _zone_ids = buildings.get_ids_by("zone")
+    _microsim_ids = buildings.get_ids_by("microsim")
+
+    def __init__(self, tile_buildings=()):
+        """
+        Args:
+            tile_buildings (iterable): ((row, col), Building) of each tile with a building on it.
+        """
+        # {building id: {Building: set of the (row, col) of the tiles it's on}}.
+        self.by_id = {}
+        for coords, building in tile_buildings:
+            self.add(coords, building)
+
+    def add(self, coords, building):
+        """
+        Records a building being on a tile.
+        Args:
+            coords (tuple): (row, col) of the tile.
+            building (Building): building on the tile.
+        """
+        self.by_id.setdefault(building.building_id, {}).setdefault(building, set()).add(coords)
+
+    def remove(self, coords, building):
+        """
+        Records a building no longer being on a tile, and forgets the building once it's not on any tiles.
+        Args:
+            coords (tuple): (row, col) of the tile.
+            building (Building): building that was on the tile.
+        """
+        placed = self.by_id.get(building.building_id, {})
+        tiles = placed.get(building)
+        if tiles is None:
+            return
+        tiles.discard(coords)
+        if not tiles:
+            del placed[building]
+            if not placed:
+                del self.by_id[building.building_id]
+
+    def update(self, events):
+        """
+        Applies building_placed and building_removed CityEvents to the index, for use as a City.subscribe() callback.
+        Args:
+            events (list): CityEvents to apply.
+        """
+        for event in events:
+            if event.kind == 'building_removed':
+                self.remove(event.coords, event.old)
+            elif event.kind == 'building_placed':
+                self.add(event.coords, event.new)
+
+    def _placed(self, building_ids):
+        """
+        Args:
+            building_ids (int or iterable): building id, or ids, to look up.
+        Returns:
+            Generator of the {Building: tiles} of each of the ids that has buildings in the city.
+        """
+        if isinstance(building_ids, int):
+            building_ids = (building_ids, )
+        return (self.by_id[x] for x in building_ids if x in self.by_id)
+
+    def find(self, building_ids):
+        """
+        Args:
+            building_ids (int or iterable): building id, or ids, to find, like 0xD2 for police stations.
+        Returns:
+            List of every Building in the city with one of the ids.
+        """
+        return [building for placed in self._placed(building_ids) for building in placed]
+
+    def count(self, building_ids):
+        """
+        Args:
+            building_ids (int or iterable): building id, or ids, to count.
+        Returns:
+            The number of buildings in the city with one of the ids.
+        """
+        return sum(len(placed) for placed in self._placed(building_ids))
+
+    def anchors(self, building_ids):
+        """
+        Args:
+            building_ids (int or iterable): building id, or ids, to find.
+        Returns:
+            Set of the (row, col) of the left corner of every building with one of the ids, which are the keys of City.buildings.
+        """
+        return {building.tile_coords for placed in self._placed(building_ids) for building in placed}
+
+    def footprint(self, building_ids):
+        """
+        Args:
+            building_ids (int or iterable): building id, or ids, to find.
+        Returns:
+            Set of the (row, col) of every tile covered by a building with one of the ids.
+        """
+        return set().union(*(tiles for placed in self._placed(building_ids) for tiles in placed.values()))
+
+    def find_zone(self, zone):
+        """
+        Args:
+            zone (str): zone of the buildings to find, like "residential" or "special", see Data/buildings.py.
+        Returns:
+            List of every Building in the city in the zone.
+        """
+        return self.find(self._zone_ids.get(zone, ()))
+
+    def find_microsim(self, microsim):
+        """
+        Args:
+            microsim (str): microsim of the buildings to find, like "police" or "hospital", see Data/buildings.py.
+        Returns:
+            List of every Building in the city with the microsim.
+        """
+        return self.find(self._microsim_ids.get(microsim, ()))
+
+    def find_arcologies(self):
+        """
+        Returns:
+            List of every arcology in the city.
+        """
+        return self.find(buildings.arcology_ids)
+
+    def __len__(self):
+        return sum(len(placed) for placed in self.by_id.values())
+
+    def __str__(self):
+        return f"Building index: {len(self)} buildings of {len(self.by_id)} kinds."
+
+
+def _bit_flag_property(bit):
+    """
+    Creates a property for one of the flags of a BitFlags.
+    Args:
+        bit (int): which bit of the flags, 7 being the most significant.
+    Returns:
+        The property.
+    """
+    mask = 1 << bit
+
+    def getter(self):
+        return bool(self.flags & mask)
+
+    def setter(self, value):
+        if value:
+            self.flags = self.flags | mask
+        else:
+            self.flags = self.flags & ~mask & 0xFF
+    return property(getter, setter)
+
+
 class BitFlags:
     """
-    Stores the bit flags and implements str() and int().
+    Stores the bit flags as a single int and implements str() and int().
     """
+    # Flag names, from the most significant bit to the least.
+    _flag_names = ('powerable', 'powered', 'piped', 'watered', 'xval', 'water', 'rotate', 'salt')
+    # bytes.translate() tables that turn a whole map of flags bytes into 0 or 1 for a single flag.
+    _mask_tables = {name: bytes((x >> (7 - bit)) & 1 for x in range(256)) for bit, name in enumerate(_flag_names)}
+
+    powerable = _bit_flag_property(7)  # Is this a tile that needs power?
+    powered = _bit_flag_property(6)  # Is this tile recieving power?
+    piped = _bit_flag_property(5)  # Does this tile have pipes underneath it?
+    watered = _bit_flag_property(4)  # Is this tile recieving water?
+    xval = _bit_flag_property(3)  # Land value of this tile
+    water = _bit_flag_property(2)  # Is this tile covered in water?
+    rotate = _bit_flag_property(1)  # Should this tile be rotated?
+    salt = _bit_flag_property(0)  # Is this tile salt water?
 
     def __init__(self, flags):
-        _flags = [bool(int(x)) for x in "{0:b}".format(flags).zfill(8)]
-        self.powerable = _flags[0]  # Is this a tile that needs power?
-        self.powered = _flags[1]  # Is this tile recieving power?
-        self.piped = _flags[2]  # Does this tile have pipes underneath it?
-        self.watered = _flags[3]  # Is this tile recieving water?
-        self.xval = _flags[4]  # Land value of this tile
-        self.water = _flags[5]  # Is this tile covered in water?
-        self.rotate = _flags[6]  # Should this tile be rotated?
-        self.salt = _flags[7]  # Is this tile salt water?
+        self.flags = int(flags)
+
+    @classmethod
+    def map_mask(cls, flags_data, flag_name):
+        """
+        Gets a single flag for a whole map of flags at once.
+        Args:
+            flags_data (bytes): row major flags bytes for every tile, like the XBIT chunk.
+            flag_name (str): name of the flag, like "powered".
+        Returns:
+            Row major bytes with 1 for each tile that has the flag set, and 0 for those that don't.
+        """
+        return bytes(flags_data).translate(cls._mask_tables[flag_name])
 
     def __str__(self):
         """
         Returns a binary string representing the bitflags.
         """
-        attrs = (self.powerable, self.powered, self.piped, self.watered, self.xval, self.water, self.rotate, self.salt)
-        bit_string = ''.join(['1' if x else '0' for x in attrs])
-        return bit_string
+        return f"{self.flags:08b}"
 
     def __int__(self):
         """
         Returns the integer corresponding to the flags.
         """
-        return int(str(self), 2)
+        return self.flags
 
     def to_int(self):
         """
@@ -677,9 +1288,7 @@ class BitFlags:
         Returns:
             An integer representation of the flags.
         """
-        res = [self.powerable, self.powered, self.piped, self.watered, self.xval, self.water, self.rotate, self.salt]
-        res = ''.join([str(int(x == True)) for x in res])
-        return int(res, 2)
+        return self.flags
 
     def to_byte(self):
         """
@@ -687,7 +1296,7 @@ class BitFlags:
         Returns:
             A single, big endian byte representation of the bitflags.
         """
-        return int_to_bytes(self.to_int(), 1)
+        return int_to_bytes(self.flags, 1)
 
 
 class Budget:
@@ -741,24 +1350,40 @@ class Budget:
         Args:
             raw_misc_data (bytes): Raw segment from Misc
         """
+        self.parse_budget_fields(misc_layout.unpack_misc(raw_misc_data))
+
+    def parse_budget_fields(self, misc_fields):
+        """
+        Sets the budget data from the already unpacked MISC fields.
+        Args:
+            misc_fields (dict): MISC fields, as from misc_layout.unpack_misc().
+        """
         # Ordinances
-        ordinance_raw = raw_misc_data[0x0FA0 : 0x0FA0 + 4]
-        self.ordinance_flags = [int(x) for x in int_to_bitstring(parse_uint32(ordinance_raw))]
+        self.ordinance_flags = [int(x) for x in int_to_bitstring(misc_fields['Ordinances'][0])]
 
         # bonds
-        start_offset = 0x0610
-        bonds_len = 50 * 4
-        self.bonds = bytes_to_int32s(raw_misc_data[start_offset : start_offset + bonds_len])
-
-        # various sub-budgets
-        sub_len = 27 * 4
-        for name, start_offset in self._sub_budget_indices.items():
-            chunk = raw_misc_data[start_offset : start_offset + sub_len]
-            sub_budget = deepcopy(self._blank_budget)
-            chunk_data = bytes_to_int32s(chunk)
-            for idx, k in enumerate(self._blank_budget):
-                sub_budget[k] = chunk_data[idx]
-            self.budget_items[name] = sub_budget
+        self.bonds = list(misc_fields['Bonds'])
+
+        # various sub-budgets, which are stored one after the other in the order of their offsets.
+        sub_len = len(self._blank_budget)
+        budget_values = misc_fields['Budget']
+        for idx, name in enumerate(sorted(self._sub_budget_indices, key=self._sub_budget_indices.get)):
+            self.budget_items[name] = dict(zip(self._blank_budget, budget_values[idx * sub_len : (idx + 1) * sub_len]))
+
+    def budget_fields(self):
+        """
+        Gets the budget data as MISC fields, for misc_layout.pack_misc().
+        Returns:
+            A dictionary of {field name: list of ints} for the Bonds, Budget and Ordinances fields.
+        """
+        budget_values = []
+        for sub_budget in self.budget_items.values():
+            budget_values.extend(sub_budget.values())
+        # Bitshifting to convert the list of 0/1s to an int.
+        bits = 0
+        for bit in self.ordinance_flags:
+            bits = (bits << 1) | bit
+        return {'Bonds': list(self.bonds), 'Budget': budget_values, 'Ordinances': [bits]}
 
     def serialize_budget(self):
         """
@@ -829,6 +1454,25 @@ class Tile(City):
         self._density_minimap = density
         self._growth_minimap = growth
 
+    def copy(self, minimaps, label):
+        """
+        Copies this tile, for a copy of the city it's in.
+        Args:
+            minimaps (dict): {name: Minimap} of the copied city, for the new tile to read its simulation values from.
+            label (dict): labels of the copied city.
+        Returns:
+            The new Tile, which has the same Building as this one.
+        """
+        new_tile = Tile.__new__(Tile)
+        new_tile.__dict__.update(self.__dict__)
+        new_tile.__dict__.pop('_events', None)
+        for name, minimap in minimaps.items():
+            setattr(new_tile, f"_{name}_minimap", minimap)
+        new_tile._label = label
+        if self.bit_flags is not None:
+            new_tile.bit_flags = BitFlags(int(self.bit_flags))
+        return new_tile
+
     @property
     def traffic(self):
         return self._traffic_minimap.get_scaled(self.coordinates)
@@ -928,6 +1572,296 @@ class Tile(City):
         return s
 
 
+class ObservedTile(Tile):
+    """
+    A Tile that notifies changes to its attributes, which City.watch_tiles() turns the tiles of a city into once something subscribes to it.
+    Note that changing a flag of its BitFlags, rather than setting bit_flags, isn't noticed.
+    """
+    _observed_attributes = frozenset(('altitude_tunnel', 'altidue_tunnel', 'water_depth', 'altitude_unknown', 'altitude', 'terrain',
+                                      'building', 'zone_corners', 'zone', 'underground', 'text_pointer', 'bit_flags'))
+
+    def __setattr__(self, name, value):
+        if name not in self._observed_attributes:
+            object.__setattr__(self, name, value)
+            return
+        old = self.__dict__.get(name)
+        object.__setattr__(self, name, value)
+        events = self.__dict__.get('_events')
+        if events is not None:
+            events.tile_changed(self.coordinates, name, old, value)
+
+
+def _tile_layer_property(layer_name):
+    """
+    Creates a property that reads and writes a tile's value in one of the layers of a TileLayers.
+    Args:
+        layer_name (str): name of the layer.
+    Returns:
+        The property.
+    """
+    def getter(self):
+        return self._tile_layers.layers[layer_name][self._idx]
+
+    def setter(self, value):
+        self._tile_layers.set_value(layer_name, self._idx, 0 if value is None else int(value))
+    return property(getter, setter)
+
+
+def _tile_minimap_property(minimap_name):
+    """
+    Creates a property for the minimap a TileView reads its simulation values from.
+    Args:
+        minimap_name (str): name of the minimap, like "traffic".
+    Returns:
+        The property.
+    """
+    def getter(self):
+        return self._tile_layers.minimaps[minimap_name]
+    return property(getter)
+
+
+class TileBitFlags(BitFlags):
+    """
+    BitFlags for a tile in a TileLayers, that reads and writes the flags stored in the bit_flags layer.
+    """
+    def __init__(self, tile_layers, idx):
+        """
+        Args:
+            tile_layers (TileLayers): the layers storing the tile.
+            idx (int): index of the tile in the layers.
+        """
+        self._tile_layers = tile_layers
+        self._idx = idx
+
+    @property
+    def flags(self):
+        return self._tile_layers.layers['bit_flags'][self._idx]
+
+    @flags.setter
+    def flags(self, val):
+        self._tile_layers.set_value('bit_flags', self._idx, val)
+
+
+class TileView(Tile):
+    """
+    A Tile that reads and writes its values from a TileLayers, rather than storing them itself.
+    These are created when a tile is accessed, so keeping one around is fine, but it's not the same object each time.
+    """
+    altitude_tunnel = _tile_layer_property('altitude_tunnel')
+    altidue_tunnel = _tile_layer_property('altidue_tunnel')
+    water_depth = _tile_layer_property('water_depth')
+    altitude_unknown = _tile_layer_property('altitude_unknown')
+    altitude = _tile_layer_property('altitude')
+    terrain = _tile_layer_property('terrain')
+    zone = _tile_layer_property('zone')
+    underground = _tile_layer_property('underground')
+    text_pointer = _tile_layer_property('text_pointer')
+    _traffic_minimap = _tile_minimap_property('traffic')
+    _pollution_minimap = _tile_minimap_property('pollution')
+    _value_minimap = _tile_minimap_property('value')
+    _crime_minimap = _tile_minimap_property('crime')
+    _police_minimap = _tile_minimap_property('police')
+    _fire_minimap = _tile_minimap_property('fire')
+    _density_minimap = _tile_minimap_property('density')
+    _growth_minimap = _tile_minimap_property('growth')
+
+    def __init__(self, tile_layers, coordinates, idx):
+        """
+        Args:
+            tile_layers (TileLayers): the layers storing this tile.
+            coordinates (tuple): (row, col) of the tile.
+            idx (int): index of the tile in the layers.
+        """
+        self._tile_layers = tile_layers
+        self.coordinates = coordinates
+        self._idx = idx
+
+    @property
+    def _label(self):
+        return self._tile_layers.labels
+
+    @property
+    def zone_corners(self):
+        # Stored as an int, but a Tile has always had this as a bit string.
+        return f"{self._tile_layers.layers['zone_corners'][self._idx]:04b}"
+
+    @zone_corners.setter
+    def zone_corners(self, val):
+        if isinstance(val, str):
+            val = int(val, 2)
+        self._tile_layers.set_value('zone_corners', self._idx, val)
+
+    @property
+    def bit_flags(self):
+        return TileBitFlags(self._tile_layers, self._idx)
+
+    @bit_flags.setter
+    def bit_flags(self, val):
+        self._tile_layers.set_value('bit_flags', self._idx, 0 if val is None else int(val))
+
+    @property
+    def building(self):
+        return self._tile_layers.building[self._idx]
+
+    @building.setter
+    def building(self, val):
+        self._tile_layers.set_value('building', self._idx, val)
+
+
+class TileLayers(collections.abc.Mapping):
+    """
+    Columnar storage for the tiles of a city, with one flat, row major array per tile attribute instead of a Tile object per tile.
+    Acts as a dictionary of {(row, col): Tile}, so existing code like tilelist[(row, col)].altitude keeps working.
+    Each Tile is a TileView created on access, and setting a tile copies its values into the layers.
+    Layers can be shared with a snapshot() of the layers, in which case they're copied the first time they're written to.
+    So all writes need to go through layer() or building_layer(), rather than straight to layers or building.
+    """
+    # Tile attributes stored as one byte per tile.
+    # altidue_tunnel holds the tunnel bits as loaded, while altitude_tunnel is what gets saved, as has always been the case for Tile.
+    # zone_corners is stored as an int, rather than the bit string a Tile has.
+    _layer_names = ('altitude_tunnel', 'altidue_tunnel', 'water_depth', 'altitude_unknown', 'altitude', 'terrain',
+                    'zone_corners', 'zone', 'underground', 'text_pointer', 'bit_flags')
+
+    def __init__(self, size, minimaps, labels, events=None):
+        """
+        Args:
+            size (int): length of a side of the city, in tiles.
+            minimaps (dict): {name: Minimap} of the 8 minimaps the tiles read their simulation values from.
+            labels (dict): the city's labels, that the tiles read their text from.
+            events (CityEvents): where to notify changes made through set_value(), or None to not notify them.
+        """
+        self.size = size
+        self.layers = {name: bytearray(size * size) for name in self._layer_names}
+        # Buildings are objects, so they're stored in a list rather than an array, with None for no building.
+        self.building = [None] * (size * size)
+        self.minimaps = minimaps
+        self.labels = labels
+        self.events = events
+        # Names of the layers, including "building", that are shared with a snapshot and need to be copied before they're changed.
+        self._shared = set()
+
+    def snapshot(self, minimaps, labels):
+        """
+        Creates a copy of these layers that shares every layer with them until one or the other writes to it.
+        Args:
+            minimaps (dict): {name: Minimap} of the minimaps the copied tiles read their simulation values from.
+            labels (dict): labels the copied tiles read their text from.
+        Returns:
+            The new TileLayers.
+        """
+        clone = TileLayers.__new__(TileLayers)
+        clone.size = self.size
+        clone.layers = dict(self.layers)
+        clone.building = self.building
+        clone.minimaps = minimaps
+        clone.labels = labels
+        clone.events = None
+        self._shared.update(self.layers, ('building', ))
+        clone._shared = set(self._shared)
+        return clone
+
+    def layer(self, layer_name):
+        """
+        Gets the whole map array for a tile attribute, to change.
+        Use layers to only read it, which doesn't need a shared layer to be copied.
+        Args:
+            layer_name (str): name of the attribute, like "altitude".
+        Returns:
+            Row major bytearray of the attribute's value for every tile, which can be modified in place.
+        """
+        if layer_name in self._shared:
+            self._shared.discard(layer_name)
+            self.layers[layer_name] = bytearray(self.layers[layer_name])
+        return self.layers[layer_name]
+
+    def building_layer(self):
+        """
+        Gets the building on every tile, to change.
+        Use building to only read it, which doesn't need it to be copied if it's shared.
+        Returns:
+            Row major list of the Building on every tile, or None, which can be modified in place.
+        """
+        if 'building' in self._shared:
+            self._shared.discard('building')
+            self.building = list(self.building)
+        return self.building
+
+    def set_value(self, layer_name, idx, value):
+        """
+        Sets the value of one tile in a layer, and notifies the change.
+        Args:
+            layer_name (str): name of the attribute, like "altitude", or "building".
+            idx (int): index of the tile.
+            value: new value.
+        """
+        layer = self.building_layer() if layer_name == 'building' else self.layer(layer_name)
+        old = layer[idx]
+        layer[idx] = value
+        if self.events is not None:
+            self.events.tile_changed(divmod(idx, self.size), layer_name, old, value)
+
+    def flag_mask(self, flag_name):
+        """
+        Gets one of the bit flags for every tile at once.
+        Args:
+            flag_name (str): name of the flag, like "powered".
+        Returns:
+            Row major bytes with 1 for each tile that has the flag set, and 0 for those that don't.
+        """
+        return BitFlags.map_mask(self.layers['bit_flags'], flag_name)
+
+    def building_ids(self):
+        """
+        Gets the id of the building on every tile.
+        Returns:
+            Row major bytearray of building ids, with 0 for tiles without a building.
+        """
+        return bytearray(0 if x is None else x.building_id for x in self.building)
+
+    def get_index(self, key):
+        """
+        Converts a tile's coordinates into its index in the layers.
+        Args:
+            key (tuple): (row, col) of the tile.
+        Returns:
+            Index of the tile.
+        Raises:
+            KeyError: if the coordinates aren't in the city.
+        """
+        try:
+            row, col = key
+        except (TypeError, ValueError):
+            raise KeyError(key) from None
+        if not (0 <= row < self.size and 0 <= col < self.size):
+            raise KeyError(key)
+        return row * self.size + col
+
+    def __getitem__(self, key):
+        return TileView(self, key, self.get_index(key))
+
+    def __setitem__(self, key, tile):
+        idx = self.get_index(key)
+        view = TileView(self, key, idx)
+        for name in self._layer_names:
+            setattr(view, name, getattr(tile, name, 0))
+        view.building = tile.building
+
+    def __contains__(self, key):
+        try:
+            self.get_index(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for row in range(self.size):
+            for col in range(self.size):
+                yield (row, col)
+
+    def __len__(self):
+        return self.size * self.size
+
+
 class Thing:
     """
     Class to represent a thing stored in the XTHG segment.
@@ -1010,37 +1944,184 @@ class Minimap:
     """
     Couldn't think of a better name, but this stores minimap info/simulation variables stores in:
     XTRF, XPLT, XVAL, XCRM, XPLC, XFIR, XPOP, XROG.
+    The values are stored in a flat, row major bytearray, and are indexed by (x, y) in minimap coordinates.
+    The bytearray can be shared with a snapshot() of the minimap, in which case it's copied the first time it's written to.
     """
     _x64 = ["XTRF", "XPLT", "XVAL", "XCRM"]
     _x32 = ["XPLC", "XFIR", "XPOP", "XROG"]
 
     def __init__(self, name='', size=0):
         self.name = name
-        self.data = {}
+        self._data = bytearray(size * size)
+        # True if _data is shared with a snapshot, and needs to be copied before it's changed.
+        self._shared = False
+        # Where to notify changes, or None to not notify them.
+        self.events = None
         self.size = size
+        # How many tiles along each side of a city map to one minimap value.
+        self.scale = 2 if size == 64 else 4
+
+    @property
+    def data(self):
+        """
+        Row major bytearray of the minimap values, which can be modified in place.
+        Use tobytes() to only read them, which doesn't need shared values to be copied.
+        """
+        if self._shared:
+            self._data = bytearray(self._data)
+            self._shared = False
+        return self._data
+
+    @data.setter
+    def data(self, val):
+        self._data = val
+        self._shared = False
+
+    def snapshot(self):
+        """
+        Creates a copy of this minimap that shares its values with it until one or the other changes them.
+        Returns:
+            The new Minimap.
+        """
+        clone = Minimap.__new__(Minimap)
+        clone.__dict__.update(self.__dict__)
+        self._shared = True
+        clone._shared = True
+        return clone
+
+    def tobytes(self):
+        """
+        Returns:
+            Row major bytes of the minimap values.
+        """
+        return bytes(self._data)
+
+    def load(self, raw_data):
+        """
+        Replaces the contents of this minimap with the bytes of a minimap chunk.
+        Args:
+            raw_data (bytes): row major minimap values, like the XTRF chunk.
+        """
+        self.data = bytearray(raw_data[ : self.size * self.size])
+        if self.events is not None:
+            self.events.minimap_changed(self.name, None, None, None)
+
+    def get_index(self, key):
+        """
+        Converts (x, y) minimap coordinates to an index into self.data.
+        Args:
+            key (tuple): (x, y) coordinates.
+        Returns:
+            Index of the value.
+        Raises:
+            KeyError: if the coordinates aren't in the minimap.
+        """
+        x, y = key
+        if not (0 <= x < self.size and 0 <= y < self.size):
+            raise KeyError(key)
+        return x * self.size + y
 
     def convert_xy(self, key):
         x, y = key
-        d = 4
-        if self.size == 64:
-            d = 2
-        x //= d
-        y //= d
-        return (x, y)
+        return (x // self.scale, y // self.scale)
 
     def get_scaled(self, key):
-        new_key = self.convert_xy(key)
-        return self.data[new_key]
+        return self._data[self.get_index(self.convert_xy(key))]
 
     def set_scaled(self, key, item):
-        new_key = self.convert_xy(key)
-        self.data[new_key] = item
+        self[self.convert_xy(key)] = item
+
+    def scaled_view(self):
+        """
+        Gets a view of this minimap at the full size of the city, without copying it.
+        Returns:
+            ScaledMinimap for this minimap.
+        """
+        return ScaledMinimap(self)
+
+    def scaled_bytes(self):
+        """
+        Upsamples this minimap to the full size of the city, repeating each value over the block of tiles it covers.
+        Returns:
+            Row major bytearray with a value for every tile in the city.
+        """
+        scale = self.scale
+        scaled_size = self.size * scale
+        output = bytearray(scaled_size * scaled_size)
+        for x in range(self.size):
+            scaled_row = bytearray(scaled_size)
+            row = self._data[x * self.size : (x + 1) * self.size]
+            for offset in range(scale):
+                scaled_row[offset : : scale] = row
+            for row_offset in range(scale):
+                start = (x * scale + row_offset) * scaled_size
+                output[start : start + scaled_size] = scaled_row
+        return output
+
+    def get_region(self, x, y, width, height):
+        """
+        Gets a rectangular block of values.
+        Args:
+            x (int): first row of the block.
+            y (int): first column of the block.
+            width (int): number of rows in the block.
+            height (int): number of columns in the block.
+        Returns:
+            Row major bytearray of the values in the block.
+        """
+        self.check_region(x, y, width, height)
+        output = bytearray()
+        for row in range(x, x + width):
+            output += self._data[row * self.size + y : row * self.size + y + height]
+        return output
+
+    def set_region(self, x, y, width, height, values):
+        """
+        Sets a rectangular block of values.
+        Args:
+            x (int): first row of the block.
+            y (int): first column of the block.
+            width (int): number of rows in the block.
+            height (int): number of columns in the block.
+            values (bytes): row major values for the block, or a single int to fill the whole block with.
+        """
+        self.check_region(x, y, width, height)
+        if isinstance(values, int):
+            values = bytes([values]) * (width * height)
+        if len(values) != width * height:
+            raise ValueError(f"Expected {width * height} values for a {width}x{height} region, got {len(values)}.")
+        old_values = self.get_region(x, y, width, height) if self.events is not None else None
+        for idx, row in enumerate(range(x, x + width)):
+            self.data[row * self.size + y : row * self.size + y + height] = values[idx * height : (idx + 1) * height]
+        if old_values is not None and old_values != values:
+            with self.events.batch():
+                for idx, (old, new) in enumerate(zip(old_values, values)):
+                    if old != new:
+                        self.events.minimap_changed(self.name, (x + idx // height, y + idx % height), old, new)
+
+    def check_region(self, x, y, width, height):
+        """
+        Checks that a rectangular block is entirely within the minimap.
+        Args:
+            x (int): first row of the block.
+            y (int): first column of the block.
+            width (int): number of rows in the block.
+            height (int): number of columns in the block.
+        Raises:
+            KeyError: if any of the block is outside of the minimap.
+        """
+        if not (0 <= x and 0 <= y and width >= 0 and height >= 0 and x + width <= self.size and y + height <= self.size):
+            raise KeyError((x, y, width, height))
 
     def __setitem__(self, key, value):
-        self.data[key] = value
+        idx = self.get_index(key)
+        old = self._data[idx]
+        self.data[idx] = value
+        if self.events is not None and old != value:
+            self.events.minimap_changed(self.name, key, old, value)
 
     def __getitem__(self, key):
-        return self.data[key]
+        return self._data[self.get_index(key)]
 
     def __str__(self):
         s = f"{self.name}:\n "
@@ -1051,6 +2132,41 @@ class Minimap:
         return s
 
 
+class ScaledMinimap(collections.abc.Mapping):
+    """
+    View of a minimap at the full size of the city, where each minimap value covers a block of tiles.
+    Acts as a dictionary of {(row, col): value} over the tiles, and reads and writes go straight to the minimap, so nothing is copied.
+    """
+    def __init__(self, minimap):
+        """
+        Args:
+            minimap (Minimap): minimap to view.
+        """
+        self.minimap = minimap
+        self.size = minimap.size * minimap.scale
+
+    def tobytes(self):
+        """
+        Returns:
+            Row major bytearray with a value for every tile in the city.
+        """
+        return self.minimap.scaled_bytes()
+
+    def __getitem__(self, key):
+        return self.minimap.get_scaled(key)
+
+    def __setitem__(self, key, value):
+        self.minimap.set_scaled(key, value)
+
+    def __iter__(self):
+        for row in range(self.size):
+            for col in range(self.size):
+                yield (row, col)
+
+    def __len__(self):
+        return self.size * self.size
+
+
 class Scenario:
     """
     Stores the scenario information for a city.
@@ -1,5 +1,15 @@
 import sc2_parse as sc2p
-from utils import serialize_int32, serialize_uint32, serialize_uint16, serialize_uint8, int_to_n_bits
+import Data.misc_layout as misc_layout
+from utils import serialize_int32, serialize_uint32, serialize_uint16, serialize_uint8, or_bytes
+
+
+# The per-tile chunks, in the order serialize_tiles() returns them.
+TILE_CHUNKS = ("ALTM", "XTER", "XZON", "XUND", "XTXT", "XBIT")
+# bytes.translate() tables for packing whole maps of tile values into ALTM and XZON bytes at once.
+ALTM_TUNNEL_HIGH_TABLE = bytes((x << 2) & 0xFF for x in range(256))
+ALTM_DEPTH_HIGH_TABLE = bytes(x >> 3 for x in range(256))
+ALTM_DEPTH_LOW_TABLE = bytes((x << 5) & 0xFF for x in range(256))
+XZON_CORNERS_TABLE = bytes((x << 4) & 0xFF for x in range(256))
 
 
 def name_to_cnam(city_name):
@@ -48,6 +58,40 @@ def serialize_chunks(chunks):
     return output_bytes
 
 
+def write_chunks(output_file, chunks, file_type="SCDH"):
+    """
+    Streams a complete IFF file, the FORM header followed by each chunk, to a binary file object.
+    If the file object can seek, the FORM size is written as a placeholder and filled in at the end.
+    Otherwise, such as for a socket, the size is worked out from the chunks before anything is written.
+    Args:
+        output_file (file): binary file object to write to.
+        chunks (list): (chunk id, chunk bytes) tuples, already compressed (or not) as required. This is a list because duplicate TEXT chunks are allowed.
+        file_type (str): type of the FORM, "SCDH" for a city. Tilesets use a MIFF header rather than a FORM, so they can't be written with this.
+    Returns:
+        Number of bytes written.
+    """
+    chunks = list(chunks)
+    seekable = hasattr(output_file, 'seekable') and output_file.seekable()
+    if seekable:
+        form_start = output_file.tell()
+        form_size = 0
+    else:
+        # The file type plus an 8 byte header for each chunk.
+        form_size = 4 + sum(8 + len(chunk_data) for _, chunk_data in chunks)
+    output_file.write(bytes("FORM", 'ascii') + serialize_int32(form_size) + bytes(file_type, 'ascii'))
+    total_bytes = 12
+    for chunk_name, chunk_data in chunks:
+        output_file.write(bytes(chunk_name, 'ascii') + serialize_int32(len(chunk_data)))
+        output_file.write(chunk_data)
+        total_bytes += 8 + len(chunk_data)
+    if seekable:
+        # FORM and length don't count.
+        output_file.seek(form_start + 4)
+        output_file.write(serialize_int32(total_bytes - 8))
+        output_file.seek(form_start + total_bytes)
+    return total_bytes
+
+
 def serialize_misc(city):
     """
     Serialized the MISC segment, 4800 bytes.
@@ -56,188 +100,42 @@ def serialize_misc(city):
     Returns:
         Byte representation of the MISC segment.
     """
-    # This is the offset of the section that's being parsed from MISC.
-    parse_order = {
-        '0x0000': 'FirstEntry',
-        '0x0004': 'GameMode',
-        '0x0008': 'Compass',
-        '0x000c': 'baseYear',
-        '0x0010': 'simCycle',
-        '0x0014': 'TotalFunds',
-        '0x0018': 'TotalBonds',
-        '0x001c': 'GameLevel',
-        '0x0020': 'CityStatus',
-        '0x0024': 'CityValue',
-        '0x0028': 'LandValue',
-        '0x002c': 'CrimeCount',
-        '0x0030': 'TrafficCount',
-        '0x0034': 'Pollution',
-        '0x0038': 'CityFame',
-        '0x003c': 'Advertising',
-        '0x0040': 'Garbage',
-        '0x0044': 'WorkerPercent',
-        '0x0048': 'WorkerHealth',
-        '0x004c': 'WorkerEducate',
-        '0x0050': 'NationalPop',
-        '0x0054': 'NationalValue',
-        '0x0058': 'NationalTax',
-        '0x005c': 'NationalTrend',
-        '0x0060': 'heat',
-        '0x0064': 'wind',
-        '0x0068': 'humid',
-        '0x006c': 'weatherTrend',
-        '0x0070': 'NewDisaster',
-        '0x0074': 'oldResPop',
-        '0x0078': 'Rewards',
-        '0x007c': 'Population Graphs',
-        '0x016c': 'Industry Graphs',
-        '0x01f0': 'Tile Counts',
-        '0x05f0': 'ZonePop|0',
-        '0x05f4': 'ZonePop|1',
-        '0x05f8': 'ZonePop|2',
-        '0x05fc': 'ZonePop|3',
-        '0x0600': 'ZonePop|4',
-        '0x0604': 'ZonePop|5',
-        '0x0608': 'ZonePop|6',
-        '0x060c': 'ZonePop|7',
-        '0x0610': 'Bonds',
-        '0x06d8': 'Neighbours',
-        '0x0718': 'Valve?|0',
-        '0x071c': 'Valve?|1',
-        '0x0720': 'Valve?|2',
-        '0x0724': 'Valve?|3',
-        '0x0728': 'Valve?|4',
-        '0x072c': 'Valve?|5',
-        '0x0730': 'Valve?|6',
-        '0x0734': 'Valve?|7',
-        '0x0738': 'gas_power',
-        '0x073c': 'nuclear_power',
-        '0x0740': 'solar_power',
-        '0x0744': 'wind_power',
-        '0x0748': 'microwave_power',
-        '0x074c': 'fusion_power',
-        '0x0750': 'airport',
-        '0x0754': 'highways',
-        '0x0758': 'buses',
-        '0x075c': 'subways',
-        '0x0760': 'water_treatment',
-        '0x0764': 'desalinisation',
-        '0x0768': 'plymouth',
-        '0x076c': 'forest',
-        '0x0770': 'darco',
-        '0x0774': 'launch',
-        '0x0778': 'highway_2',
-        '0x077c': 'Budget',
-        '0x0e3c': 'YearEnd',
-        '0x0e40': 'GlobalSeaLevel',
-        '0x0e44': 'terCoast',
-        '0x0e48': 'terRiver',
-        '0x0e4c': 'Military',
-        '0x0e50': 'Paper List',
-        '0x0ec8': 'News List',
-        '0x0fa0': 'Ordinances',
-        '0x0fa4': 'unemployed',
-        '0x0fa8': 'Military Count',
-        '0x0fe8': 'SubwayCnt',
-        '0x0fec': 'GameSpeed',
-        '0x0ff0': 'AutoBudget',
-        '0x0ff4': 'AutoGo',
-        '0x0ff8': 'UserSoundOn',
-        '0x0ffc': 'UserMusicOn',
-        '0x1000': 'NoDisasters',
-        '0x1004': 'PaperDeliver',
-        '0x1008': 'PaperExtra',
-        '0x100c': 'PaperChoice',
-        '0x1010': 'unknown128',
-        '0x1014': 'Zoom',
-        '0x1018': 'CityCentX',
-        '0x101c': 'CityCentY',
-        '0x1020': 'GlobalArcoPop',
-        '0x1024': 'ConnectTiles',
-        '0x1028': 'TeamsActive',
-        '0x102c': 'TotalPop',
-        '0x1030': 'IndustryBonus',
-        '0x1034': 'PolluteBonus',
-        '0x1038': 'oldArrest',
-        '0x103c': 'PoliceBonus',
-        '0x1040': 'DisasterObject',
-        '0x1044': 'CurrentDisaster',
-        '0x1048': 'GoDisaster',
-        '0x104c': 'SewerBonus',
-        '0x1050': 'Extra', }
-    handle_special = ['Population Graphs', 'Industry Graphs', 'Tile Counts', 'Bonds', 'Neighbours', 'Budget',
-                      'Military Count', 'Paper List', 'News List', 'Extra', 'Ordinances']
-    handle_special += list(city.simulator_settings.keys()) + list(city.game_settings.keys()) + list(city.inventions.keys())
-    output_bytes = bytearray(b"\x00" * 4800)
-    for k, v in parse_order.items():
-        offset = int(k, 16)
-        if v not in handle_special:
-            data = serialize_uint32(city.city_attributes[v])
-            output_bytes[offset : offset + 4] = data
-        elif v == 'Population Graphs':
-            graph_values = [[a for a in g] for g in city.population_graphs.values()]
-            data = interleave_data(graph_values)
-            output_bytes[offset: offset + len(data)] = data
-        elif v == 'Industry Graphs':
-            graph_values = [[a for a in g] for g in city.industry_graphs.values()]
-            data = interleave_data(graph_values)
-            output_bytes[offset: offset + len(data)] = data
-        elif v == 'Tile Counts':
-            for building_count in city.building_count.values():
-                data = serialize_int32(building_count)
-                output_bytes[offset : offset + 4] = data
-                offset += 4
-        elif v == 'Bonds':
-            bonds_data = city.budget.serialize_bonds()
-            output_bytes[offset : offset + len(bonds_data)] = bonds_data
-        elif v == 'Ordinances':
-            data = city.budget.serialize_ordinances()
-            output_bytes[offset : offset + 4] = data
-        elif v == 'Neighbours':
-            for n in city.neighbor_info.values():
-                for e in n.values():
-                    data = serialize_int32(e)
-                    output_bytes[offset: offset + 4] = data
-                    offset += 4
-        elif v == 'Budget':
-            budget_data = city.budget.serialize_budget()
-            output_bytes[offset : offset + len(budget_data)] = budget_data
-        elif v == 'Military Count':
-            num_items = 16
-            for x in range(num_items):
-                data = serialize_int32(city.city_attributes[f"Military Count|{x}"])
-                output_bytes[offset: offset + 4] = data
-                offset += 4
-        elif v == 'Paper List':
-            num_items = 6 * 5
-            for x in range(num_items):
-                data = serialize_int32(city.city_attributes[f"Paper List|{x}"])
-                output_bytes[offset: offset + 4] = data
-                offset += 4
-        elif v == 'News List':
-            num_items = 9 * 6
-            for x in range(num_items):
-                data = serialize_int32(city.city_attributes[f"News List|{x}"])
-                output_bytes[offset: offset + 4] = data
-                offset += 4
-        elif v == 'Extra':
-            for x in range(156):
-                data = serialize_int32(city.city_attributes[f"Extra|{x}"])
-                output_bytes[offset: offset + 4] = data
-                offset += 4
-        elif v in list(city.simulator_settings.keys()):
-            data = serialize_int32(city.simulator_settings[v])
-            output_bytes[offset: offset + 4] = data
-        elif v in list(city.game_settings.keys()):
-            data = serialize_int32(city.game_settings[v])
-            output_bytes[offset: offset + 4] = data
-        elif v in list(city.inventions.keys()):
-            data = serialize_int32(city.inventions[v])
-            output_bytes[offset: offset + 4] = data
+    misc_fields = {}
+    budget_fields = city.budget.budget_fields()
+    for _, k, num_items, _ in misc_layout.MISC_LAYOUT:
+        if k == 'Population Graphs':
+            misc_fields[k] = interleave_values(list(city.population_graphs.values()))
+        elif k == 'Industry Graphs':
+            misc_fields[k] = interleave_values(list(city.industry_graphs.values()))
+        elif k == 'Tile Counts':
+            misc_fields[k] = list(city.building_count.values())
+        elif k in ('Bonds', 'Ordinances', 'Budget'):
+            misc_fields[k] = budget_fields[k]
+        elif k == 'Neighbours':
+            misc_fields[k] = [e for n in city.neighbor_info.values() for e in n.values()]
+        elif k in ('Military Count', 'Paper List', 'News List', 'Extra'):
+            misc_fields[k] = [city.city_attributes[f"{k}|{x}"] for x in range(num_items)]
+        elif k in city.simulator_settings:
+            misc_fields[k] = [city.simulator_settings[k]]
+        elif k in city.game_settings:
+            misc_fields[k] = [city.game_settings[k]]
+        elif k in city.inventions:
+            misc_fields[k] = [city.inventions[k]]
         else:
-            # Fallthrough, this should never, ever, be hit.
-            print("MISC is missing something!", k, v)
-    return output_bytes
+            misc_fields[k] = [city.city_attributes[k]]
+    return misc_layout.pack_misc(misc_fields)
+
+
+def interleave_values(data):
+    """
+    Interleaves the Population and Industry Graphs, as ints rather than bytes.
+    Each of the lists must be the same length.
+    Args:
+        data (list(list(int))): List of lists of the graph data.
+    Returns:
+        List of the interleaved values.
+    """
+    return [a for values in zip(*data) for a in values]
 
 
 def interleave_data(data):
@@ -259,7 +157,8 @@ def interleave_data(data):
 
 def serialize_tile_data(city, which_tile):
     """
-
+    Serializes one of the per-tile chunks.
+    When saving, use serialize_tiles() instead, which does all of them in one go.
     Args:
         city (City): city to serialize the tiles from.
         which_tile (str): which tile type are we serializing?
@@ -267,33 +166,89 @@ def serialize_tile_data(city, which_tile):
     Returns:
         Bytearray representation of the tiles.
     """
+    if which_tile not in TILE_CHUNKS:
+        print("Tile data parsing failed.")
+        return bytearray()
+    return serialize_tiles(city)[which_tile]
+
+
+def serialize_tiles(city):
+    """
+    Serializes all of the per-tile chunks in a single pass over the tiles.
+    If the city stores its tiles in a TileLayers, the chunks are packed from the layers for the whole map at once instead.
+    Args:
+        city (City): city to serialize the tiles from.
+    Returns:
+        A dictionary of {chunk id: bytearray representation of the tiles} for ALTM, XTER, XZON, XUND, XTXT and XBIT.
+    """
     tilelist = city.tilelist
-    output_bytes = bytearray()
-    for tile in tilelist.values():
-        if which_tile == "ALTM":
-            bit_string = ''
-            bit_string += int_to_n_bits(tile.altitude_tunnel, 8)
-            bit_string += int_to_n_bits(tile.water_depth, 5)
-            bit_string += int_to_n_bits(tile.altitude, 5)
-            altidude_map = int(bit_string, 2)
-            tile_data = serialize_uint16(altidude_map)
-        elif which_tile == "XUND":
-            tile_data = serialize_uint8(tile.underground)
-        elif which_tile == "XTER":
-            tile_data = serialize_uint8(tile.terrain)
-        elif which_tile == "XZON":
-            zone_data = int(f"{tile.zone_corners}{int_to_n_bits(tile.zone, 4)}", 2)
-            tile_data = serialize_uint8(zone_data)
-        elif which_tile == "XTXT":
-            tile_data = serialize_uint8(tile.text_pointer)
-        elif which_tile == "XBIT":
-            flags = tile.bit_flags
-            tile_data = serialize_uint8(int(flags))
+    if isinstance(tilelist, sc2p.TileLayers) and tile_layers_packable(tilelist):
+        return serialize_tile_layers(tilelist)
+    num_tiles = len(tilelist)
+    altm = bytearray(num_tiles * 2)
+    xter = bytearray(num_tiles)
+    xzon = bytearray(num_tiles)
+    xund = bytearray(num_tiles)
+    xtxt = bytearray(num_tiles)
+    xbit = bytearray(num_tiles)
+    for tile_idx, tile in enumerate(tilelist.values()):
+        # Tunnel, followed by 5 bits each of water depth and altitude.
+        # A value too big for its field pushes the fields before it up, rather than being masked, the same as joining the bit strings of each field would.
+        altitude = tile.altitude
+        water_depth = tile.water_depth
+        if altitude <= 0x1F and water_depth <= 0x1F:
+            altm_bits = (tile.altitude_tunnel << 10) | (water_depth << 5) | altitude
         else:
-            print("Tile data parsing failed.")
-            tile_data = 0
-        output_bytes += tile_data
-    return output_bytes
+            altitude_bits = max(5, altitude.bit_length())
+            depth_bits = max(5, water_depth.bit_length())
+            altm_bits = (tile.altitude_tunnel << (depth_bits + altitude_bits)) | (water_depth << altitude_bits) | altitude
+        altm[tile_idx * 2 : tile_idx * 2 + 2] = serialize_uint16(altm_bits)
+        xter[tile_idx] = tile.terrain
+        zone = tile.zone
+        xzon[tile_idx] = (int(tile.zone_corners, 2) << max(4, zone.bit_length())) | zone
+        xund[tile_idx] = tile.underground
+        xtxt[tile_idx] = tile.text_pointer
+        xbit[tile_idx] = int(tile.bit_flags)
+    return {"ALTM": altm, "XTER": xter, "XZON": xzon, "XUND": xund, "XTXT": xtxt, "XBIT": xbit}
+
+
+def tile_layers_packable(tile_layers):
+    """
+    Checks that every value in a TileLayers fits in the bits it's packed into, so the chunks can be packed for the whole map at once.
+    Otherwise, the values spill over into the neighbouring fields, which is only reproduced by going tile by tile.
+    Args:
+        tile_layers (TileLayers): layers to check.
+    Returns:
+        True if the layers can be packed all at once, False otherwise.
+    """
+    field_limits = {'altitude_tunnel': 0x3F, 'water_depth': 0x1F, 'altitude': 0x1F, 'zone_corners': 0x0F, 'zone': 0x0F}
+    return all(max(tile_layers.layers[name], default=0) <= limit for name, limit in field_limits.items())
+
+
+def serialize_tile_layers(tile_layers):
+    """
+    Packs the per-tile chunks from a TileLayers for the whole map at once.
+    Assumes tile_layers_packable() is True.
+    Args:
+        tile_layers (TileLayers): layers to serialize.
+    Returns:
+        A dictionary of {chunk id: bytearray representation of the tiles} for ALTM, XTER, XZON, XUND, XTXT and XBIT.
+    """
+    tunnel = tile_layers.layers['altitude_tunnel']
+    depth = tile_layers.layers['water_depth']
+    altm = bytearray(len(tunnel) * 2)
+    # ALTM is big endian, so the high byte of each tile comes first.
+    altm[0 : : 2] = or_bytes(tunnel.translate(ALTM_TUNNEL_HIGH_TABLE), depth.translate(ALTM_DEPTH_HIGH_TABLE))
+    altm[1 : : 2] = or_bytes(depth.translate(ALTM_DEPTH_LOW_TABLE), tile_layers.layers['altitude'])
+    xzon = bytearray(or_bytes(tile_layers.layers['zone_corners'].translate(XZON_CORNERS_TABLE), tile_layers.layers['zone']))
+    return {
+        "ALTM": altm,
+        "XTER": bytearray(tile_layers.layers['terrain']),
+        "XZON": xzon,
+        "XUND": bytearray(tile_layers.layers['underground']),
+        "XTXT": bytearray(tile_layers.layers['text_pointer']),
+        "XBIT": bytearray(tile_layers.layers['bit_flags']),
+    }
 
 
 def serialize_building_data(city):
@@ -320,6 +275,12 @@ def serialize_building_data(city):
         output_bytes[offset] = v.building_id
     # Why not pull from the city.buildings here?
     # Because it doesn't store holes in buildings, but that are stores in the tilelist.
+    if isinstance(tilelist, sc2p.TileLayers):
+        # Going through the building layer directly avoids creating a TileView for every tile.
+        for offset, building in enumerate(tilelist.building):
+            if building is not None:
+                output_bytes[offset] = building.building_id
+        return output_bytes
     for k, v in tilelist.items():
         x, y = k
         offset = x * 128 + y
@@ -382,11 +343,7 @@ def serialize_minimap(city, minimap):
     Returns:
         Byte representation of the minimap..
     """
-    minimap_bytes = bytearray()
-    minimap_data = getattr(city, minimap).data
-    for x in minimap_data.values():
-        minimap_bytes += serialize_uint8(x)
-    return minimap_bytes
+    return bytearray(getattr(city, minimap).tobytes())
 
 def serialize_graphs(city):
     """
@@ -411,14 +368,31 @@ def serialize_scenario(city):
     Returns:
         Byte representation of the scenario, or None if there is no scenario.
     """
-    scen = city.scenario
-    if not scen:
+    if not city.scenario:
         return None
     scen_data = bytearray()
+    for chunk_name, chunk_bytes in scenario_chunks(city):
+        raw_data = serialize_chunks({chunk_name: chunk_bytes})
+        scen_data += raw_data
+    return scen_data
+
+
+def scenario_chunks(city):
+    """
+    Gets the scenario chunks, if there's a scenario.
+    These chunks are always uncompressed.
+    Args:
+        city (City): city to pull things from.
+    Returns:
+        A list of (chunk id, chunk bytes) tuples, which is empty if there is no scenario.
+    """
+    scen = city.scenario
+    if not scen:
+        return []
+    chunks = []
     for chunk_name, chunk_bytes in scen.serialize_scenario().items():
         # A bit of jank to handle the duplicated TEXT entries for the scenario.
         if chunk_name in ("TEXT1", "TEXT2"):
                 chunk_name = "TEXT"
-        raw_data = serialize_chunks({chunk_name: chunk_bytes})
-        scen_data += raw_data
-    return scen_data
\ No newline at end of file
+        chunks.append((chunk_name, chunk_bytes))
+    return chunks
\ No newline at end of file
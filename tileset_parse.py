@@ -1,6 +1,6 @@
 import sc2_iff_parse as sc2ip
 import image_parse
-from utils import open_file, trim_cstring
+from utils import open_file, trim_cstring, parse_uint32
 
 """
 Library to parse the .mif files for tilesets, as per spec here:
@@ -17,8 +17,7 @@ def open_and_uncompress_mif_file(input_filename):
         Uncompressed MIFF data.
     """
     raw_sc2_file = open_file(input_filename)
-    compressed_data = sc2ip.chunk_input_serial(raw_sc2_file, 'mif')
-    uncompressed_data = sc2ip.sc2_uncompress_input(compressed_data, 'mif')
+    uncompressed_data = sc2ip.ChunkDirectory(raw_sc2_file, 'mif')
     return uncompressed_data
 
 
@@ -113,3 +112,110 @@ def parse_miff(miff_data):
             new_shape = Shape(raw_data=x[1], raw_name=name_data)
             shapes_array.append(new_shape)
     return shapes_array
+
+
+class MiffIndex:
+    """
+    Random access index over the shapes in a MIFF TILE chunk.
+    Only the NAME and SHAP entry headers are scanned up front, and a Shape is only created the first time it's asked for, and then cached.
+    Name linkage works the same as parse_miff(), where a shape uses the most recent NAME entry before it.
+    """
+    def __init__(self, miff_data):
+        """
+        Args:
+            miff_data (dict): uncompressed MIFF data, as from open_and_uncompress_mif_file().
+        """
+        self.tile_data = miff_data["TILE"]
+        # [(shape id, offset of the NAME data or None, size of the NAME data, offset of the SHAP data, size of the SHAP data)] in file order.
+        self.entries = []
+        # {shape id: index into self.entries}. If a shape id is repeated, the first one is used.
+        self.shape_ids = {}
+        self._shapes = {}
+        name_entry = (None, 0)
+        offset = 2
+        tile_len = len(self.tile_data)
+        while offset < tile_len:
+            entry_type = bytes(self.tile_data[offset : offset + 4]).decode('ascii')
+            entry_size = parse_uint32(self.tile_data[offset + 4 : offset + 8])
+            data_offset = offset + 8
+            if entry_type == 'NAME':
+                name_entry = (data_offset, entry_size)
+            else:
+                shape_id = int.from_bytes(self.tile_data[data_offset : data_offset + 2], byteorder='big')
+                self.shape_ids.setdefault(shape_id, len(self.entries))
+                self.entries.append((shape_id, name_entry[0], name_entry[1], data_offset, entry_size))
+            offset = data_offset + entry_size
+
+    @classmethod
+    def from_file(cls, input_filename):
+        """
+        Opens a .mif file and indexes its shapes.
+        Args:
+            input_filename (path): path the the .mif file to open.
+        Returns:
+            MiffIndex of the file.
+        """
+        return cls(open_and_uncompress_mif_file(input_filename))
+
+    def get_name(self, shape_id):
+        """
+        Gets the custom name of a shape, without decoding the shape.
+        Args:
+            shape_id (int): id of the shape.
+        Returns:
+            The name, or None if the shape doesn't have one.
+        """
+        _, name_offset, name_size, _, _ = self.entries[self.shape_ids[shape_id]]
+        if name_offset is None:
+            return None
+        return trim_name(self.tile_data[name_offset + 4 : name_offset + name_size])
+
+    def get_shape(self, shape_id):
+        """
+        Gets a shape, decoding it if this is the first time it's been asked for.
+        Args:
+            shape_id (int): id of the shape.
+        Returns:
+            Shape object.
+        """
+        try:
+            return self._shapes[shape_id]
+        except KeyError:
+            pass
+        shape = self.decode_entry(self.shape_ids[shape_id])
+        self._shapes[shape_id] = shape
+        return shape
+
+    def decode_entry(self, entry_idx):
+        """
+        Decodes a shape from its entry, without caching it.
+        Args:
+            entry_idx (int): index of the entry in self.entries.
+        Returns:
+            Shape object.
+        """
+        _, name_offset, name_size, shape_offset, shape_size = self.entries[entry_idx]
+        raw_name = None
+        if name_offset is not None:
+            raw_name = self.tile_data[name_offset : name_offset + name_size]
+        return Shape(raw_data=self.tile_data[shape_offset : shape_offset + shape_size], raw_name=raw_name)
+
+    def shapes(self):
+        """
+        Decodes all of the shapes, including any with repeated ids, in the same order as parse_miff().
+        Returns:
+            A list of Shape objects.
+        """
+        return [self.get_shape(shape_id) if self.shape_ids[shape_id] == idx else self.decode_entry(idx) for idx, (shape_id, *_) in enumerate(self.entries)]
+
+    def __getitem__(self, shape_id):
+        return self.get_shape(shape_id)
+
+    def __contains__(self, shape_id):
+        return shape_id in self.shape_ids
+
+    def __iter__(self):
+        return iter(self.shape_ids)
+
+    def __len__(self):
+        return len(self.shape_ids)
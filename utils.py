@@ -1,5 +1,8 @@
 from struct import pack, unpack
 from collections.abc import Iterable
+import mmap
+import os
+import secrets
 
 
 def flatten(l):
@@ -29,6 +32,24 @@ def open_file(input_file):
         return f.read()
 
 
+def open_file_mmap(input_file):
+    """
+    Convenience function that memory maps a file and returns a read-only view of its binary contents.
+    Slicing the view doesn't copy anything, so only the parts of the file that are actually used get read from disk.
+    Args:
+        input_file (path): full path of a file to open.
+    Returns:
+        A memoryview of the raw binary contents of the input file.
+    """
+    with open(input_file, 'rb') as f:
+        try:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be memory mapped.
+            return memoryview(b'')
+    return memoryview(mapped_file)
+
+
 def write_file_contents(output_file, data):
     """
     Convenience function that opens a file and writes binary content to it.
@@ -40,6 +61,25 @@ def write_file_contents(output_file, data):
         f.write(data)
 
 
+def open_temp_file(output_file):
+    """
+    Creates a new, uniquely named, temporary file next to a file, for writing to and then renaming over it.
+    Unlike tempfile, the file gets the same permissions open() would give a new file, based on the umask.
+    Args:
+        output_file (path): full path of the file the temporary file is for.
+    Returns:
+        A tuple of (path of the temporary file, binary file object open for writing to it).
+    """
+    directory, filename = os.path.split(os.path.abspath(output_file))
+    while True:
+        temp_path = os.path.join(directory, f".{filename}.{secrets.token_hex(4)}.tmp")
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        except FileExistsError:
+            continue
+        return temp_path, os.fdopen(fd, 'wb')
+
+
 def get_padded_bytes(base_10_int, n):
     """
     Converts a base 10 int into bytes with padding 0s to make it the required 4B.
@@ -141,6 +181,32 @@ def serialize_uint8(integer):
     return pack('>B', integer)
 
 
+def or_bytes(a, b):
+    """
+    Bitwise ORs two equal length byte strings together, byte by byte.
+    This is done all at once by treating each as one big integer, which is much faster than looping over the bytes.
+    Args:
+        a (bytes): first byte string.
+        b (bytes): second byte string.
+    Returns:
+        Bytes where each byte is the OR of the bytes at the same position in a and b.
+    """
+    return (int.from_bytes(a, 'big') | int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+def xor_bytes(a, b):
+    """
+    Bitwise XORs two equal length byte strings together, byte by byte, the same way as or_bytes().
+    Bytes that are the same in a and b come out as 0, so this is a quick way of finding where they differ.
+    Args:
+        a (bytes): first byte string.
+        b (bytes): second byte string.
+    Returns:
+        Bytes where each byte is the XOR of the bytes at the same position in a and b.
+    """
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
 def int_to_bitstring(int_input, pad=0):
     """
     Converts an into into its binary representation as a string of 0s and 1s.